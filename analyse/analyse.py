@@ -21,13 +21,24 @@ def main(argv):
        
         try:
             numerrors = c.execute("select count(*) from errors").fetchall()[0][0]
-            errors = c.execute("select distinct error from errors").fetchall()
-            errors = [ e[0] for e in errors ]
-            if len(errors) > 0:
-                print "\nTotal number of errors: %i" % numerrors
-                print "Distinct errors:"
-                for r in errors: print r
-                print
+            has_codes = c.execute("select count(*) from sqlite_master where type = 'table' and name = 'error_codes'").fetchall()[0][0]
+            if has_codes:
+                errors = c.execute("select E.error, C.kind, C.name, count(*) from errors E left outer join " \
+                    "(select distinct code, kind, name from error_codes) C on E.error = C.code group by E.error").fetchall()
+                if len(errors) > 0:
+                    print "\nTotal number of errors: %i" % numerrors
+                    print "Distinct errors (code, kind, name, count):"
+                    for r in errors: print "%s\t%s\t%s\t%i" % r
+                    print
+            else:
+                # Databases from before error codes store the error messages
+                errors = c.execute("select distinct error from errors").fetchall()
+                errors = [ e[0] for e in errors ]
+                if len(errors) > 0:
+                    print "\nTotal number of errors: %i" % numerrors
+                    print "Distinct errors:"
+                    for r in errors: print r
+                    print
         except Exception, e:
             print "Error reading table 'errors': %s" % e
         
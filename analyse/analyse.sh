@@ -21,6 +21,14 @@ if [ ! -f "$file" ]; then
 fi
 echo "Using database file $file"
 
+# basic.sql keeps existing intermediate tables, as combine.sh prepares them. Drop them if results were added since.
+stale=`run_sql "$file" <<< "select (select count(*) from SOURCETABLE) != (select count(*) from all_requests);" 2> /dev/null`
+if [ "$stale" == "1" ]; then
+    echo "Results were added since the last analysis, dropping intermediate tables"
+    run_sql "$file" <<< "drop table if exists seconds; drop table if exists minsecond; drop table if exists all_requests;
+        drop table if exists requests; drop table if exists errors; drop table if exists active_requests; drop table if exists active_requests_minutes;"
+fi
+
 for a in $analyses; do
     sqlfile="$home/analyses/$a.sql"
     if [ -f "$sqlfile" ]; then
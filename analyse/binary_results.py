@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Reader for the binary result files written by loadgen.py --sink binary (format described in binary_sink.py),
+# and exporter to the sqlite results table.
+
+from __future__ import print_function
+import sqlite3
+import struct
+import json
+import sys
+import os
+import numpy as np
+
+MAGIC = b"LGRESLT1"
+
+# Number of records exported to sqlite at once.
+EXPORT_CHUNK = 100000
+
+def read_header(path):
+    """Return the JSON header and the offset of the first record."""
+    with open(path, "rb") as f:
+        magic = f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise Exception("%s is not a binary result file." % path)
+        length, = struct.unpack("<I", f.read(4))
+        header = json.loads(f.read(length).decode("utf-8"))
+    return header, len(MAGIC) + 4 + length
+
+def load(path):
+    """Memory-map the records of a binary result file. Returns the header, a structured array with
+    one field per column, and the list of interned strings (index 0 stands for NULL)."""
+    header, offset = read_header(path)
+    dtype = np.dtype([ (str(name), str(typ)) for name, typ in header["columns"] ])
+    # Ignore an incomplete record at the end, e.g. after a crash
+    count = (os.path.getsize(path) - offset) // dtype.itemsize
+    if count > 0:
+        records = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,))
+    else:
+        records = np.zeros(0, dtype=dtype)
+    return header, records, load_strings(path)
+
+def load_strings(path):
+    strings = [ None ]
+    if os.path.exists(path + ".strings"):
+        with open(path + ".strings") as f:
+            strings += [ json.loads(line) for line in f ]
+    return strings
+
+def export_sqlite(path, db_file):
+    """Insert all records into the results table of the given database, creating it if necessary."""
+    header, records, strings = load(path)
+    table = header["table"]
+    conn = sqlite3.connect(db_file)
+    try:
+        c = conn.cursor()
+        exists = c.execute("select count(*) from sqlite_master where type = 'table' and name = ?", (table,)).fetchone()[0]
+        if not exists:
+            c.execute(header["create_query"])
+        placeholders = ", ".join(["?"] * len(header["columns"]))
+        for begin in range(0, len(records), EXPORT_CHUNK):
+            chunk = records[begin:begin + EXPORT_CHUNK]
+            columns = []
+            for name, typ in header["columns"]:
+                values = chunk[name]
+                if typ == "<i4":
+                    columns.append([ strings[code] for code in values.tolist() ])
+                else:
+                    columns.append([ None if v != v else v for v in values.tolist() ])
+            c.executemany("insert into %s values (%s);" % (table, placeholders), zip(*columns))
+        conn.commit()
+        print("Exported %i results into table %s of %s" % (len(records), table, db_file))
+    finally:
+        conn.close()
+
+def main(argv):
+    if len(argv) not in [1, 2]:
+        print("Parameters: <binary result file> [sqlite3 database file]")
+        print("Exports the results into the database, by default the one the file was written for (<db>.bin).")
+        return 1
+    path = argv[0]
+    if len(argv) == 2:
+        db_file = argv[1]
+    elif path.endswith(".bin"):
+        db_file = path[:-len(".bin")]
+    else:
+        print("Cannot derive database file name from %s" % path)
+        return 1
+    export_sqlite(path, db_file)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,16 +1,20 @@
 
 attach "HOST.db" as HOST;
 
-create table if not exists errors (second integer, start integer, end integer, time integer, error text, system text);
+create table if not exists errors (second integer, start integer, end integer, time integer, error integer, system text);
 insert into errors select *, "HOST" as system from HOST.errors;
 
+-- combine.sh leaves out the insert for databases from before error codes, which have no error_codes table
+create table if not exists error_codes (code integer, kind text, name text, count integer, system text);
+insert into error_codes select *, "HOST" as system from HOST.error_codes;
+
 create table if not exists seconds (second integer, system text);
 insert into seconds select *, "HOST" as system from HOST.seconds A where not exists (select 1 from seconds B where A.second == B.second);
 
 create table if not exists minsecond (second integer, system text, offset integer);
 insert into minsecond select second, "HOST" as system, 0 as offset from HOST.minsecond;
 
-create table if not exists SOURCETABLE (start integer, request_time integer, error text, system text);
+create table if not exists SOURCETABLE (start integer, request_time integer, error integer, system text);
 insert into SOURCETABLE select *, "HOST" as system from HOST.SOURCETABLE;
 
 create table if not exists requests (second integer, start integer, end integer, time integer, system text);
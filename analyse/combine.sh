@@ -20,6 +20,9 @@ script=
 for h in $hosts; do
     test -f "$h".db || { echo File "$h".db not found; exit 1; }
     subscript=${scriptpart//HOST/$h}
+    if ! sqlite3 "$h".db "select name from sqlite_master where name = 'error_codes';" | grep -q error_codes; then
+        subscript=`echo "$subscript" | grep -vF "from $h.error_codes"`
+    fi
     script="$script
 
 $subscript"
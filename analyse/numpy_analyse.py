@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+# Single-pass replacement for analyse.sh: reads the raw results once in chunks and writes the same analyse_* tables.
+# Concurrency is derived from per-second prefix sums instead of the range join in basic.sql.
+# The intermediate tables of basic.sql (seconds, requests, errors, ...) are not created, run analyse.sh
+# on databases that are merged with combine.sh.
+# Tables downsampled with loadgen.py --sample_rate are analysed with the weight of every row.
+# The per-second sums are kept in the analyse_state table. With --incremental, only rows added since the
+# last analysis are read, so it can run periodically during an experiment.
+
+from __future__ import print_function
+import sqlite3
+import sys
+import glob
+import os
+import numpy as np
+
+# Number of rows read from the database at once.
+CHUNK_ROWS = 100000
+
+# Per-second sums of every analysed table, and the last analysed rowid (stored with name 'rowid').
+CREATE_STATE_QUERY = "create table if not exists analyse_state (source text, name text, offset integer, data blob);"
+
+class SecondBins(object):
+    """Per-second sums indexed by absolute second, growing as new seconds are added."""
+
+    def __init__(self):
+        self.offset = None
+        self.values = np.zeros(0)
+
+    def add(self, seconds, weights=None):
+        if len(seconds) == 0:
+            return
+        first, last = int(seconds.min()), int(seconds.max())
+        if self.offset is None:
+            self.offset = first
+        if first < self.offset:
+            self.values = np.concatenate([ np.zeros(self.offset - first), self.values ])
+            self.offset = first
+        size = max(len(self.values), last - self.offset + 1)
+        counts = np.bincount(seconds - self.offset, weights, minlength=size)
+        if len(self.values) < size:
+            self.values = np.concatenate([ self.values, np.zeros(size - len(self.values)) ])
+        self.values += counts
+
+    def range(self, first, last):
+        """Values of the seconds first to last (inclusive), zero where nothing was added."""
+        result = np.zeros(last - first + 1)
+        if self.offset is None:
+            return result
+        lo, hi = max(first, self.offset), min(last, self.offset + len(self.values) - 1)
+        if lo <= hi:
+            result[lo - first:hi - first + 1] = self.values[lo - self.offset:hi - self.offset + 1]
+        return result
+
+class Analysis(object):
+    """Per-second aggregates of one results table, filled chunk by chunk. All aggregates are sums, so
+    analyses of consecutive parts of a table can be continued."""
+
+    BINS = [ "all", "ok", "errors", "time", "active_first", "active_last", "active_first_time", "active_last_time" ]
+
+    def __init__(self):
+        self.all = SecondBins()
+        self.ok = SecondBins()
+        self.errors = SecondBins()
+        self.time = SecondBins()
+        # A successful request is active in the seconds first..last (as in basic.sql: start < second+1 and end > second).
+        # Counting firsts and lasts per second allows prefix sums over any range of seconds.
+        self.active_first = SecondBins()
+        self.active_last = SecondBins()
+        self.active_first_time = SecondBins()
+        self.active_last_time = SecondBins()
+
+    def add(self, start, time, error, weight=None):
+        """Add a chunk of results. weight is the number of requests every row stands for, None for one each."""
+        second = np.floor(start).astype(np.int64)
+        if weight is None:
+            weight = np.ones(len(start))
+            weighted_time = time
+        else:
+            weighted_time = time * weight
+        self.all.add(second, weight)
+        self.errors.add(second[error], weight[error])
+        self.time.add(second, weighted_time)
+        ok = ~error
+        start, time, weighted_time, second, weight = start[ok], time[ok], weighted_time[ok], second[ok], weight[ok]
+        self.ok.add(second, weight)
+        first = np.floor(start - 1).astype(np.int64) + 1
+        last = np.ceil(start + time).astype(np.int64) - 1
+        # Requests active in no second (first > last) are added to both sides and cancel out
+        self.active_first.add(first, weight)
+        self.active_last.add(last, weight)
+        self.active_first_time.add(first, weighted_time)
+        self.active_last_time.add(last, weighted_time)
+
+    def save(self, cursor, source, last_rowid):
+        cursor.execute(CREATE_STATE_QUERY)
+        cursor.execute("delete from analyse_state where source = ?", (source,))
+        rows = [ (source, name, getattr(self, name).offset, sqlite3.Binary(getattr(self, name).values.astype(np.float64).tobytes()))
+                 for name in self.BINS ]
+        cursor.executemany("insert into analyse_state values (?, ?, ?, ?)", rows + [ (source, "rowid", last_rowid, None) ])
+
+    @staticmethod
+    def load(cursor, source):
+        """Return the saved analysis of a table and its last analysed rowid, or a new analysis and 0."""
+        analysis = Analysis()
+        cursor.execute(CREATE_STATE_QUERY)
+        state = dict([ (name, (offset, data)) for name, offset, data in
+            cursor.execute("select name, offset, data from analyse_state where source = ?", (source,)) ])
+        if "rowid" not in state:
+            return analysis, 0
+        for name in Analysis.BINS:
+            bins = getattr(analysis, name)
+            bins.offset, data = state[name]
+            bins.values = np.frombuffer(bytes(data), dtype=np.float64).copy()
+        return analysis, state["rowid"][0]
+
+    def tables(self, weighted=False):
+        """Rows of all analyse_* tables, as dict of table name to (column names, rows).
+        Request counts are integers like in analyse.sh, unless they are estimated from weighted rows."""
+        if self.all.offset is None:
+            return {}
+        count = (lambda values: values) if weighted else (lambda values: values.astype(np.int64))
+        present = np.nonzero(self.all.values)[0]
+        first, last = self.all.offset + int(present[0]), self.all.offset + int(present[-1])
+        seconds = np.arange(first, last + 1)
+        all_requests, ok, errors, time = [ bins.range(first, last) for bins in (self.all, self.ok, self.errors, self.time) ]
+        exists = all_requests > 0
+        relative = seconds - first
+
+        def active(first_bins, last_bins, window=1):
+            # Number (or summed durations) of requests active in the seconds s .. s+window-1.
+            # That is #(first <= s+window-1) - #(last <= s-1), as no request ends before it starts.
+            if first_bins.offset is None:
+                return lambda s: np.zeros(len(s))
+            begin = min(first_bins.offset, last_bins.offset)
+            end = max(first_bins.offset + len(first_bins.values), last_bins.offset + len(last_bins.values)) - 1
+            started = np.cumsum(first_bins.range(begin, end))
+            ended = np.cumsum(last_bins.range(begin, end))
+            def at(cumulative, s):
+                return np.where(s < begin, 0, cumulative[np.clip(s - begin, 0, end - begin)])
+            return lambda s: at(started, s + window - 1) - at(ended, s - 1)
+
+        active_count = active(self.active_first, self.active_last)(seconds)
+        active_time = active(self.active_first_time, self.active_last_time)(seconds)
+        minutes = np.arange(0, relative[-1] // 60 + 1)
+        minute_count = active(self.active_first, self.active_last, 60)(first + minutes * 60)
+        minute_time = active(self.active_first_time, self.active_last_time, 60)(first + minutes * 60)
+
+        # Two-second buckets relative to the first second, labelled with their first second containing requests
+        pairs = relative // 2
+        smoothed = []
+        for pair in np.unique(pairs[exists]):
+            in_pair = (pairs == pair) & exists
+            smoothed.append((int(relative[in_pair][0]), count(all_requests[in_pair].sum()).item()))
+
+        def rows(mask, *columns):
+            return [ tuple(v.item() for v in row) for row in zip(*[ c[mask] for c in columns ]) ]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return {
+                "analyse_agg_durations": (["second", "duration"], rows(exists, relative, time / all_requests)),
+                "analyse_agg_errors": (["second", "errors"], rows(exists, relative, count(errors))),
+                "analyse_error_rate": (["second", "error_rate"], rows(exists, relative, errors / all_requests)),
+                "analyse_agg_requests": (["second", "count(*)"], rows(ok > 0, relative, count(ok))),
+                "analyse_agg_all_requests": (["second", "count(*)"], rows(exists, relative, count(all_requests))),
+                "analyse_requests_smoothed_2sec": (["cast(min(start) as integer)", "count"], smoothed),
+                "analyse_requests_per_second": (["second", "count(*)"], rows(exists & (active_count > 0), relative, count(active_count))),
+                "analyse_durations_per_second": (["second", "data"], rows(exists & (active_count > 0), relative, active_time / active_count)),
+                "analyse_requests_per_minute": (["minute", "count(*)"], rows(minute_count > 0, minutes, count(minute_count))),
+                "analyse_durations_per_minute": (["minute", "avg(time)"], rows(minute_count > 0, minutes, minute_time / minute_count)),
+            }
+
+def is_weighted(cursor, table):
+    """Whether the rows of a table are downsampled and carry a weight column."""
+    return "weight" in [ row[1] for row in cursor.execute("pragma table_info(%s)" % table) ]
+
+def read_chunks(cursor, table, after_rowid=0):
+    """Yield start, request time, error flag, weight (None if the table has no weights) and the last rowid
+    of chunks of the rows after the given rowid."""
+    weighted = is_weighted(cursor, table)
+    cursor.execute("select rowid, start, request_time, error is not null%s from %s where rowid > ? order by rowid;"
+        % (", weight" if weighted else "", table), (after_rowid,))
+    while True:
+        rows = cursor.fetchmany(CHUNK_ROWS)
+        if not rows:
+            break
+        data = np.array(rows, dtype=np.float64)
+        yield data[:,1], data[:,2], data[:,3] != 0, data[:,4] if weighted else None, rows[-1][0]
+
+def write_tables(cursor, tables):
+    for name, (columns, rows) in sorted(tables.items()):
+        print("Writing %s (%i rows)" % (name, len(rows)))
+        cursor.execute("drop table if exists %s;" % name)
+        cursor.execute("create table %s (%s);" % (name, ", ".join([ '"%s"' % c for c in columns ])))
+        cursor.executemany("insert into %s values (%s);" % (name, ", ".join(["?"] * len(columns))), rows)
+
+def main(argv):
+    incremental = "--incremental" in argv
+    argv = [ a for a in argv if a != "--incremental" ]
+    if len(argv) not in [1, 2]:
+        print("Parameters: [--incremental] <table name to analyse> [.db file]")
+        print("--incremental only reads the rows added since the last analysis of the table.")
+        return 1
+    table = argv[0]
+    if len(argv) == 2:
+        db_file = argv[1]
+    else:
+        # Use the newest *.db file in current directory
+        files = sorted(glob.glob("tests.sqlite.*.db"), key=os.path.getmtime)
+        if not files:
+            print("No *.db file found in current directory, please provide as parameter")
+            return 1
+        db_file = files[-1]
+    print("Using database file %s" % db_file)
+    conn = sqlite3.connect(db_file)
+    try:
+        c = conn.cursor()
+        if incremental:
+            analysis, last_rowid = Analysis.load(c, table)
+            print("Continuing after row %i" % last_rowid)
+        else:
+            analysis, last_rowid = Analysis(), 0
+        rows = 0
+        for start, time, error, weight, last_rowid in read_chunks(c, table, last_rowid):
+            analysis.add(start, time, error, weight)
+            rows += len(start)
+        print("Analysed %i rows" % rows)
+        analysis.save(c, table, last_rowid)
+        write_tables(c, analysis.tables(is_weighted(c, table)))
+        conn.commit()
+    finally:
+        conn.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+
+# Benchmarks of loadgen.py itself: maximum request rate, dispatch accuracy of the schedules, result writer
+# throughput, memory per in-flight request and startup time. Uses the request generators in noop.py and the
+# local mock cloud (mock_openstack.py). Results are written as JSON and can be compared against a baseline:
+#
+#   python benchmarks/benchmark.py --output baseline.json
+#   python benchmarks/benchmark.py --compare baseline.json
+
+from __future__ import print_function
+import sys, os, json, time, socket, subprocess, tempfile, shutil, threading, argparse, platform, sqlite3, multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [ ROOT, HERE ]
+import loadgen
+
+# Seconds every load generator run lasts.
+DURATION = 5
+
+# Identity port of the mock cloud started for the benchmarks.
+MOCK_PORT = 15100
+
+# Relative change of a metric in its bad direction that counts as regression.
+TOLERANCE = 0.2
+
+# Seconds between two samples of the resident memory of a load generator.
+MEMORY_POLL_INTERVAL = 0.1
+
+# Metrics and whether higher (1) or lower (-1) values are better.
+METRICS = {
+    "achieved_rps": 1,
+    "rate_error": -1,
+    "lag_p50_ms": -1,
+    "lag_p99_ms": -1,
+    "lag_max_ms": -1,
+    "records_per_second": 1,
+    "commits_per_second": 1,
+    "bytes_per_request": -1,
+    "startup_seconds": -1,
+    "latency_p99_ms": -1,
+}
+
+def resident_memory(pid):
+    """Resident set size of a process in bytes, None where /proc is not available."""
+    try:
+        with open("/proc/%i/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class LoadgenRun(object):
+    """One loadgen.py process with its own temporary database."""
+
+    def __init__(self, klass, options, params=(), duration=DURATION):
+        self.directory = tempfile.mkdtemp(prefix="loadgen-benchmark-")
+        self.db = os.path.join(self.directory, "results.db")
+        self.command = [ sys.executable, os.path.join(ROOT, "loadgen.py"), "-k", klass, "-d", self.db,
+            "-t", str(duration), "--report_interval", "0" ] + list(options)
+        if params:
+            self.command += [ "-p" ] + list(params)
+        self.started = None
+        self.peak_memory = None
+
+    def run(self):
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join([ ROOT, HERE ] + ([ env["PYTHONPATH"] ] if env.get("PYTHONPATH") else []))
+        self.started = time.time()
+        with open(os.devnull, "w") as devnull:
+            process = subprocess.Popen(self.command, env=env, stdout=devnull, stderr=devnull)
+            while process.poll() is None:
+                memory = resident_memory(process.pid)
+                if memory is not None and (self.peak_memory is None or memory > self.peak_memory):
+                    self.peak_memory = memory
+                time.sleep(MEMORY_POLL_INTERVAL)
+        if process.returncode != 0:
+            raise Exception("%s failed with exit code %i" % (" ".join(self.command), process.returncode))
+        return self
+
+    def query(self, sql):
+        connection = sqlite3.connect(self.db)
+        try:
+            return connection.execute(sql).fetchall()
+        finally:
+            connection.close()
+
+    def achieved_rps(self, table):
+        count, first, last = self.query("select count(*), min(start), max(start) from %s" % table)[0]
+        return count / (last - first) if count > 1 and last > first else 0.0
+
+    def startup_seconds(self, table):
+        return self.query("select min(start) from %s" % table)[0][0] - self.started
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+def measure(klass, options, params=(), duration=DURATION):
+    return LoadgenRun(klass, options, params, duration).run()
+
+# ======== Benchmarks without network requests
+
+def max_rps(engine, duration):
+    if engine == 'asyncio':
+        run = measure("noop_async.AsyncNoopGenerator", [ "-e", "asyncio", "-r", "100000" ], duration=duration)
+    else:
+        run = measure("noop.NoopGenerator", [ "-r", "100000" ], duration=duration)
+    try:
+        return { "achieved_rps": run.achieved_rps("noop"), "startup_seconds": run.startup_seconds("noop") }
+    finally:
+        run.close()
+
+def dispatch_accuracy(schedule, duration, rate=1000):
+    run = measure("noop.NoopGenerator", [ "-r", str(rate), "-s", schedule ], duration=duration)
+    try:
+        lags = [ row[0] for row in run.query("select lag from noop where lag is not null") ]
+        achieved = run.achieved_rps("noop")
+        return {
+            "achieved_rps": achieved,
+            "rate_error": abs(achieved / rate - 1),
+            "lag_p50_ms": percentile(lags, 50) * 1000,
+            "lag_p99_ms": percentile(lags, 99) * 1000,
+            "lag_max_ms": max(lags) * 1000,
+        }
+    finally:
+        run.close()
+
+def memory_per_request(engine, duration, in_flight=2000, sleep=2.0):
+    # Difference of the peak memory with in_flight long-running requests and with (almost) none
+    if engine == 'asyncio':
+        rate = int(in_flight / sleep)
+        def peak(sleep):
+            run = measure("noop_async.AsyncNoopGenerator", [ "-e", "asyncio", "-r", str(rate) ], [ "sleep=%s" % sleep ], duration)
+            run.close()
+            return run.peak_memory
+        idle, loaded = peak(0), peak(sleep)
+    else:
+        def peak(users):
+            run = measure("noop.NoopGenerator", [ "-u", str(users) ], [ "sleep=%s" % sleep ], duration)
+            run.close()
+            return run.peak_memory
+        idle, loaded = peak(1), peak(in_flight + 1)
+    if idle is None or loaded is None:
+        return { "bytes_per_request": None }
+    return { "bytes_per_request": float(loaded - idle) / in_flight }
+
+class Quiet(object):
+    """Discards the output of the load generator while running in-process."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+    def __exit__(self, type, value, traceback):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def writer_throughput(count=200000, threads=4):
+    """record_results from several threads into the result writer, in the benchmark process."""
+    from noop import NoopGenerator
+    directory = tempfile.mkdtemp(prefix="loadgen-benchmark-")
+    try:
+        with Quiet():
+            generator = NoopGenerator(argparse.Namespace(db=os.path.join(directory, "results.db")))
+            per_thread = count // threads
+            def record():
+                now = time.time()
+                for _ in range(per_thread):
+                    generator.record_results((now, 0.001, None))
+            workers = [ threading.Thread(target=record) for _ in range(threads) ]
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            recorded = time.time()
+            generator.flush_results()
+            written = time.time()
+        return { "records_per_second": per_thread * threads / (recorded - start),
+                 "commits_per_second": per_thread * threads / (written - start) }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# ======== Benchmarks against the mock cloud
+
+class MockCloud(object):
+    def __init__(self, port):
+        self.port = port
+
+    def __enter__(self):
+        with open(os.devnull, "w") as devnull:
+            self.process = subprocess.Popen([ sys.executable, os.path.join(ROOT, "mock_openstack.py"),
+                "--port", str(self.port), "--report_interval", "0" ], stdout=devnull, stderr=devnull)
+        deadline = time.time() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", self.port), 1).close()
+                return self
+            except socket.error:
+                if time.time() > deadline:
+                    self.process.kill()
+                    raise Exception("Mock cloud did not start on port %i" % self.port)
+                time.sleep(0.1)
+
+    def __exit__(self, type, value, traceback):
+        self.process.terminate()
+        self.process.wait()
+
+def mock_rps(engine, duration, port):
+    params = [ "service=compute", "host=127.0.0.1", "identity_port=%i" % port, "user=u", "password=p", "tenant=t" ]
+    if engine == 'asyncio':
+        run = measure("loadgen_async.AsyncOpenstackRequestGenerator", [ "-e", "asyncio", "-r", "20000" ], params, duration)
+    else:
+        run = measure("loadgen_custom_api.OpenstackRequestGenerator", [ "-r", "20000" ], params, duration)
+    try:
+        p99 = run.query("select p99 from histograms where scope = 'total'")
+        return { "achieved_rps": run.achieved_rps("compute"), "startup_seconds": run.startup_seconds("compute"),
+                 "latency_p99_ms": p99[0][0] * 1000 if p99 and p99[0][0] is not None else None }
+    finally:
+        run.close()
+
+def benchmarks(duration, port):
+    """All benchmarks as (name, function)."""
+    result = [
+        ("max_rps_threads", lambda: max_rps('threads', duration)),
+        ("max_rps_asyncio", lambda: max_rps('asyncio', duration)),
+        ("dispatch_constant", lambda: dispatch_accuracy('constant', duration)),
+        ("dispatch_poisson", lambda: dispatch_accuracy('poisson', duration)),
+        ("writer", writer_throughput),
+        ("memory_threads", lambda: memory_per_request('threads', duration)),
+        ("memory_asyncio", lambda: memory_per_request('asyncio', duration)),
+    ]
+    def with_mock(function):
+        def run():
+            with MockCloud(port):
+                return function()
+        return run
+    result += [
+        ("mock_threads", with_mock(lambda: mock_rps('threads', duration, port))),
+        ("mock_asyncio", with_mock(lambda: mock_rps('asyncio', duration, port))),
+    ]
+    return result
+
+def best(results):
+    """Combine the results of repeated runs of a benchmark into the best value of every metric."""
+    combined = {}
+    for metric in results[0]:
+        values = [ r[metric] for r in results if r.get(metric) is not None ]
+        combined[metric] = (max if METRICS.get(metric, 1) > 0 else min)(values) if values else None
+    return combined
+
+def compare(baseline, current, tolerance):
+    """Print the change of every metric, return the number of regressions."""
+    regressions = 0
+    print("%-20s %-20s %12s %12s %8s" % ("benchmark", "metric", "baseline", "current", "change"))
+    for name, metrics in sorted(current.items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get(name, {}).get(metric)
+            if old is None or value is None:
+                continue
+            change = (value - old) / abs(old) if old else 0.0
+            regression = change * METRICS.get(metric, 1) < -tolerance
+            regressions += regression
+            print("%-20s %-20s %12.3f %12.3f %+7.1f%%%s" % (name, metric, old, value, change * 100, "  REGRESSION" if regression else ""))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks of the load generator itself.')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file.')
+    parser.add_argument('--compare', default=None, help='Compare the results with this JSON file written by --output. Exits with 1 on regressions.')
+    parser.add_argument('--tolerance', default=TOLERANCE, type=float, help='Relative change in the bad direction that counts as regression.')
+    parser.add_argument('--duration', default=DURATION, type=int, help='Seconds every load generator run lasts.')
+    parser.add_argument('--mock_port', default=MOCK_PORT, type=int, help='Identity port of the mock cloud. The following 7 ports are used as well.')
+    parser.add_argument('--repeat', default=1, type=int, help='Run every benchmark this many times and keep the best value of every metric.')
+    parser.add_argument('--only', nargs='*', help='Names of the benchmarks to run.')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, function in benchmarks(args.duration, args.mock_port):
+        if args.only and name not in args.only:
+            continue
+        loadgen.log("Running %s..." % name)
+        try:
+            results[name] = best([ function() for _ in range(args.repeat) ])
+        except Exception as e:
+            loadgen.log("Benchmark %s failed: %s" % (name, e))
+            continue
+        loadgen.log("%s: %s" % (name, ", ".join([ "%s %s" % (k, "-" if v is None else "%.3f" % v) for k, v in sorted(results[name].items()) ])))
+
+    report = { "time": time.time(), "host": platform.node(), "python": platform.python_version(),
+               "cpus": multiprocessing.cpu_count(), "duration": args.duration, "benchmarks": results }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        loadgen.log("Results written to %s" % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline["benchmarks"], results, args.tolerance) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
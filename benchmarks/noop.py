@@ -0,0 +1,24 @@
+
+# Request generators without network requests, measuring the overhead of loadgen.py itself (see benchmark.py).
+
+import time
+import loadgen
+
+def check_args(args):
+    loadgen.check_params(args, [], { 'sleep': (float, 0) })
+
+class NoopGenerator(loadgen.LoadGenerator):
+    """Records a successful result for every request, after sleeping for the sleep parameter (seconds)."""
+    create_query = "create table noop (start real, request_time real, error integer);"
+    commit_query = "insert into noop values (?, ?, ?);"
+
+    def __init__(self, args):
+        check_args(args)
+        super(NoopGenerator, self).__init__(args)
+        self.auth_url = "noop"
+
+    def execute_request(self):
+        start = time.time()
+        if self.args.sleep > 0:
+            time.sleep(self.args.sleep)
+        self.record_results((start, time.time() - start, None))
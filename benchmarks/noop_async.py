@@ -0,0 +1,13 @@
+
+# NoopGenerator for the asyncio engine. Requires Python 3.
+
+import asyncio, time
+from noop import NoopGenerator
+
+class AsyncNoopGenerator(NoopGenerator):
+
+    async def execute_request_async(self, extra):
+        start = time.time()
+        if self.args.sleep > 0:
+            await asyncio.sleep(self.args.sleep)
+        self.record_results((start, time.time() - start, None), extra)
@@ -0,0 +1,66 @@
+
+# Compact binary result file, written instead of the rows of the sqlite results table (loadgen.py --sink binary).
+#
+# Layout: 8 bytes magic, little-endian uint32 header length, JSON header, fixed-width little-endian records.
+# The header lists the record columns as [name, numpy type]: '<f8' for numeric columns (NaN for NULL),
+# '<i4' for text columns holding codes of interned strings (0 for NULL). String n is line n of the
+# file <path>.strings, every line a JSON string. analyse/binary_results.py memory-maps these files.
+
+import json, struct
+
+MAGIC = b"LGRESLT1"
+
+# The data section starts at a multiple of this many bytes.
+HEADER_ALIGNMENT = 8
+
+class BinaryResultSink(object):
+    """Appends result rows to a binary result file. Used from the result writer thread only."""
+
+    def __init__(self, path, table, create_query, column_types):
+        self.path = path
+        self.columns = []
+        formats = []
+        self.text_columns = []
+        for i, (name, sql_type) in enumerate(column_types):
+            if sql_type.lower() == "text":
+                self.columns.append([name, "<i4"])
+                formats.append("i")
+                self.text_columns.append(i)
+            else:
+                self.columns.append([name, "<f8"])
+                formats.append("d")
+        self.record = struct.Struct("<" + "".join(formats))
+        self.strings = {}
+        header = json.dumps({ "table": table, "create_query": create_query, "columns": self.columns }).encode("utf-8")
+        length = len(MAGIC) + 4 + len(header)
+        header += b" " * (-length % HEADER_ALIGNMENT)
+        self.file = open(path, "wb")
+        self.file.write(MAGIC + struct.pack("<I", len(header)) + header)
+        self.strings_file = open(path + ".strings", "w")
+
+    def intern(self, string):
+        if string is None:
+            return 0
+        code = self.strings.get(string)
+        if code is None:
+            code = len(self.strings) + 1
+            self.strings[string] = code
+            self.strings_file.write(json.dumps(string) + "\n")
+        return code
+
+    def append(self, rows):
+        pack = self.record.pack
+        nan = float("nan")
+        data = []
+        for row in rows:
+            row = list(row)
+            for i in self.text_columns:
+                row[i] = self.intern(row[i])
+            data.append(pack(*[ nan if value is None else value for value in row ]))
+        self.file.write(b"".join(data))
+        self.file.flush()
+        self.strings_file.flush()
+
+    def close(self):
+        self.file.close()
+        self.strings_file.close()
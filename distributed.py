@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+
+# Distributed load generation: a controller starts load generators on several agents at a synchronized instant
+# and collects their results into one database, while they run.
+#
+#   python distributed.py agent [--port 7700]
+#   python distributed.py controller -a host1:7700 -a host2:7700 <loadgen.py options>
+#
+# The request generator class given with -k must be importable on all agents. Controller and agents exchange
+# JSON objects, one per line, over TCP:
+#   controller -> agent: ping, run (loadgen.py arguments), stop
+#   agent -> controller: pong (agent clock), rows (new rows of one table in the agent's database), done (exit code)
+# Agents run loadgen.py in a child process writing a temporary database, which is streamed to the controller.
+# Timestamps are converted to the controller clock, using the offset measured with ping messages.
+#
+# Agents do not authenticate controllers: anyone who can connect to an agent can make it import and run any
+# Python class. Agents therefore listen on 127.0.0.1 by default. Only listen on other addresses (--host) in
+# networks where every host that can reach the port is trusted, e.g. behind a firewall or an SSH tunnel.
+
+from __future__ import print_function
+import sys, os, time, json, socket, signal, sqlite3, threading, multiprocessing, argparse, copy, shutil, tempfile
+import loadgen
+import histogram
+import error_codes
+from loadgen import log
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+DEFAULT_PORT = 7700
+
+# Number of ping messages used to measure the clock offset of an agent. The one with the shortest
+# round trip gives the offset.
+SYNC_PINGS = 20
+
+# Seconds between the start command and the synchronized start of all agents. Must cover creating the
+# request generators (including authentication) on the agents.
+START_DELAY = loadgen.PROCESS_START_DELAY
+
+# Seconds between two scans of the agent database for new rows.
+STREAM_INTERVAL = 1.0
+
+# Maximum number of rows sent in one message.
+STREAM_BATCH = 10000
+
+# Seconds the controller waits for messages before checking for stopped agents.
+RECEIVE_TIMEOUT = 0.5
+
+class Connection(object):
+    """JSON-lines messages over a TCP socket. send() can be used from several threads."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = sock.makefile('r')
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + "\n").encode('utf-8')
+        with self.lock:
+            self.sock.sendall(data)
+
+    def receive(self):
+        """Next message, or None if the connection was closed."""
+        line = self.reader.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def close(self):
+        try:
+            self.reader.close()
+            self.sock.close()
+        except Exception as e:
+            log("Error closing connection: %s" % e)
+
+# ======== Agent
+
+class DatabaseTail(object):
+    """Reads the rows added to the tables of a database since the last call, by rowid."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.last_rowid = {}
+
+    def read(self):
+        """Yield (table, create sql, column names, rows) for all new rows."""
+        if self.connection is None:
+            if not os.path.exists(self.path):
+                return
+            self.connection = sqlite3.connect(self.path)
+        c = self.connection.cursor()
+        tables = c.execute("select name, sql from sqlite_master where type = 'table'").fetchall()
+        for name, sql in tables:
+            while True:
+                c.execute("select rowid, * from %s where rowid > ? order by rowid limit ?" % name,
+                    (self.last_rowid.get(name, 0), STREAM_BATCH))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                self.last_rowid[name] = rows[-1][0]
+                columns = [ d[0] for d in c.description[1:] ]
+                yield name, sql, columns, [ row[1:] for row in rows ]
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+class AgentSession(object):
+    """Handles one controller connection: answers pings, then runs loadgen.py once and streams its results."""
+
+    def __init__(self, connection, directory):
+        self.connection = connection
+        self.directory = directory
+        self.process = None
+
+    def run(self):
+        while True:
+            message = self.connection.receive()
+            if message is None:
+                log("Controller disconnected")
+                return
+            if message["type"] == "ping":
+                self.connection.send({ "type": "pong", "time": time.time() })
+            elif message["type"] == "run":
+                self.execute(message["args"])
+                return
+            else:
+                log("Unexpected message: %s" % message["type"])
+
+    def execute(self, arguments):
+        directory = tempfile.mkdtemp(prefix="loadgen-agent-", dir=self.directory)
+        args = argparse.Namespace(**arguments)
+        args.db = os.path.join(directory, "results.db")
+        log("Starting %s, %s requests per second, %s users, database %s" % (args.klass, args.requests_per_second, args.users, args.db))
+        self.process = multiprocessing.Process(target=loadgen.run_shard, args=(args,))
+        self.process.start()
+        control = threading.Thread(target=self.control_worker)
+        control.daemon = True
+        control.start()
+        tail = DatabaseTail(args.db)
+        try:
+            while True:
+                self.process.join(STREAM_INTERVAL)
+                running = self.process.is_alive()
+                # Also scan once after the process exited, for the last results
+                self.send_rows(tail)
+                if not running:
+                    break
+        finally:
+            tail.close()
+            if self.process.is_alive():
+                self.stop()
+                self.process.join()
+        log("Load generator exited with code %s" % self.process.exitcode)
+        self.connection.send({ "type": "done", "status": self.process.exitcode })
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def send_rows(self, tail):
+        for table, sql, columns, rows in tail.read():
+            self.connection.send({ "type": "rows", "table": table, "sql": sql, "columns": columns, "rows": rows })
+
+    def control_worker(self):
+        while True:
+            message = self.connection.receive()
+            if message is None or message["type"] == "stop":
+                if self.process.is_alive():
+                    log("Controller disconnected, stopping" if message is None else "Stopping on request of the controller")
+                    self.stop()
+                return
+
+    def stop(self):
+        os.kill(self.process.pid, signal.SIGINT)
+
+def run_agent(host, port, directory):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    log("Agent listening on %s:%i" % (host, port))
+    while True:
+        sock, address = server.accept()
+        log("Controller connected from %s:%i" % address)
+        connection = Connection(sock)
+        try:
+            AgentSession(connection, directory).run()
+        except Exception as e:
+            log("Error in session with %s:%i: %s" % (address + (e,)))
+        finally:
+            connection.close()
+
+# ======== Controller
+
+def timestamp_columns(table):
+    """Names of the columns holding absolute timestamps in the given table."""
+    if table == 'error_samples':
+        return ['time']
+    return ['start']
+
+class Agent(object):
+    """Controller side of the connection to one agent."""
+
+    def __init__(self, address):
+        host, port = address.rsplit(":", 1)
+        self.address = address
+        self.connection = Connection(socket.create_connection((host, int(port))))
+        self.offset = 0
+        self.status = None
+        self.finished = False
+
+    def synchronize(self, pings=SYNC_PINGS):
+        """Measure the offset of the agent clock from the local clock."""
+        best = None
+        for _ in range(pings):
+            sent = time.time()
+            self.connection.send({ "type": "ping" })
+            reply = self.connection.receive()
+            received = time.time()
+            if reply is None:
+                raise Exception("Agent %s disconnected" % self.address)
+            rtt = received - sent
+            if best is None or rtt < best[0]:
+                best = (rtt, reply["time"] - (sent + received) / 2)
+        self.offset = best[1]
+        log("Agent %s: clock offset %.2f ms (round trip %.2f ms)" % (self.address, self.offset * 1000, best[0] * 1000))
+
+    def receive_worker(self, messages):
+        while True:
+            message = self.connection.receive()
+            messages.put((self, message))
+            if message is None or message["type"] == "done":
+                return
+
+class ResultCollector(object):
+    """Writes the rows streamed by the agents into one database. Only used from the controller main thread."""
+
+    def __init__(self, db):
+        self.connection = sqlite3.connect(db)
+        # Error tables exist even if no agent reports errors, like in databases of single-host runs
+        c = self.connection.cursor()
+        c.execute(error_codes.CREATE_CODES_QUERY)
+        c.execute(error_codes.CREATE_SAMPLES_QUERY)
+        self.connection.commit()
+        self.tables = set([ 'error_codes', 'error_samples' ])
+        self.histogram_rows = []
+        self.rows = 0
+
+    def add(self, agent, table, sql, columns, rows):
+        if table == 'histograms':
+            self.histogram_rows += [ self.convert_histogram(agent, row) for row in rows ]
+            return
+        c = self.connection.cursor()
+        if table not in self.tables:
+            exists = c.execute("select count(*) from sqlite_master where type = 'table' and name = ?", (table,)).fetchone()[0]
+            if not exists:
+                c.execute(sql)
+            self.tables.add(table)
+        shifted = [ i for i, name in enumerate(columns) if name in timestamp_columns(table) ]
+        if shifted:
+            rows = [ list(row) for row in rows ]
+            for row in rows:
+                for i in shifted:
+                    if row[i] is not None:
+                        row[i] -= agent.offset
+        c.executemany("insert into %s values (%s)" % (table, ", ".join(["?"] * len(columns))), rows)
+        self.connection.commit()
+        if table not in ('error_codes', 'error_samples'):
+            self.rows += len(rows)
+
+    def convert_histogram(self, agent, row):
+        # Interval histograms stay aligned to their interval length, so intervals of all agents can be merged
+        row = list(row)
+        start, duration = row[2] - agent.offset, row[3]
+        if row[1] == 'interval' and duration > 0:
+            start = round(start / duration) * duration
+        row[2] = start
+        return row
+
+    def close(self):
+        c = self.connection.cursor()
+        if self.histogram_rows:
+            c.execute(histogram.CREATE_HISTOGRAMS_QUERY)
+            c.executemany(histogram.INSERT_HISTOGRAM_QUERY, histogram.merge_histogram_rows(self.histogram_rows))
+        error_codes.merge_codes(c)
+        self.connection.commit()
+        self.connection.close()
+
+def agent_args(args, agents, index, start_at):
+    """loadgen.py arguments of one agent, as JSON object."""
+    a = copy.copy(args)
+    n = len(agents)
+    a.requests_per_second = loadgen.share(args.requests_per_second, n, index)
+    a.requests_increment = loadgen.share(args.requests_increment, n, index)
+    a.users = loadgen.share(args.users, n, index)
+    # As with --processes, agent i is delayed by i/n of a request interval
+    a.start_at = start_at + agents[index].offset + float(index) / max(args.requests_per_second, 1)
+    if args.trace:
+        # Every agent replays every n-th request of its copy of the trace, from the same start. The trace sets the rate.
+        a.trace_shard = (index, n)
+        a.start_at = start_at + agents[index].offset
+        a.requests_per_second = args.requests_per_second
+    a.stats_port = 0
+    arguments = vars(a)
+    del arguments["db"]
+    return arguments
+
+def run_controller(addresses, args, start_delay):
+    if args.search or args.processes > 1 or args.sink != 'sqlite':
+        print("--search, --processes and --sink binary cannot be used with distributed runs.")
+        return 1
+    n = len(addresses)
+    if args.users > 0 and args.users < n:
+        print("Need at least one user for each of the %i agents." % n)
+        return 1
+    if args.users == 0 and not args.trace and args.requests_per_second < n:
+        print("Need at least one request per second for each of the %i agents." % n)
+        return 1
+
+    agents = [ Agent(address) for address in addresses ]
+    for agent in agents:
+        agent.synchronize()
+    start_at = time.time() + start_delay
+    messages = queue.Queue()
+    for i, agent in enumerate(agents):
+        agent.connection.send({ "type": "run", "args": agent_args(args, agents, i, start_at) })
+        thread = threading.Thread(target=agent.receive_worker, args=(messages,))
+        thread.daemon = True
+        thread.start()
+    log("Starting %i agents in %.1f seconds, writing to %s" % (n, start_delay, args.db))
+
+    def signal_handler(signum, frame):
+        log("Signal %s caught, stopping %i agents." % (signum, n))
+        for agent in agents:
+            if not agent.finished:
+                try:
+                    agent.connection.send({ "type": "stop" })
+                except Exception as e:
+                    log("Cannot stop agent %s: %s" % (agent.address, e))
+    signal.signal(signal.SIGINT, signal_handler)
+
+    collector = ResultCollector(args.db)
+    try:
+        while not all([ agent.finished for agent in agents ]):
+            try:
+                agent, message = messages.get(timeout=RECEIVE_TIMEOUT)
+            except queue.Empty:
+                continue
+            if message is None:
+                log("Agent %s disconnected" % agent.address)
+                agent.finished = True
+            elif message["type"] == "rows":
+                collector.add(agent, message["table"], message["sql"], message["columns"], message["rows"])
+            elif message["type"] == "done":
+                log("Agent %s finished with exit code %s" % (agent.address, message["status"]))
+                agent.status = message["status"]
+                agent.finished = True
+    finally:
+        collector.close()
+        for agent in agents:
+            agent.connection.close()
+    log("Collected %i results from %i agents into %s" % (collector.rows, n, args.db))
+    return 0 if all([ agent.status == 0 for agent in agents ]) else 1
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Distributed load generation with loadgen.py.')
+    subparsers = parser.add_subparsers(dest='mode')
+    agent = subparsers.add_parser('agent', help='Wait for a controller and generate load as instructed.')
+    agent.add_argument('--host', default='127.0.0.1', help='Address to listen on. Agents run any request generator class a controller sends, without authentication: only listen on addresses reachable from trusted hosts, e.g. 0.0.0.0 inside a firewalled test network.')
+    agent.add_argument('--port', default=DEFAULT_PORT, type=int, help='Port to listen on.')
+    agent.add_argument('--directory', default=None, help='Directory for the temporary result databases.')
+    controller = subparsers.add_parser('controller',
+        help='Run loadgen.py on the given agents. All other options are passed to loadgen.py, -r, -i and -u are split among the agents, as are the requests of --trace.')
+    controller.add_argument('-a', '--agent', action='append', required=True, help='host:port of an agent. Can be given multiple times.')
+    controller.add_argument('--start_delay', default=START_DELAY, type=float, help='Seconds between starting the agents and the synchronized start of the load.')
+    if not argv:
+        parser.print_help()
+        return 1
+    args, loadgen_argv = parser.parse_known_args(argv)
+    if args.mode == 'agent':
+        if loadgen_argv:
+            parser.error("unrecognized arguments: %s" % " ".join(loadgen_argv))
+        run_agent(args.host, args.port, args.directory)
+        return 0
+    loadgen_args = loadgen.parse_args(loadgen_argv)
+    if loadgen_args is None:
+        return 1
+    return run_controller([ a if ":" in a else "%s:%i" % (a, DEFAULT_PORT) for a in args.agent ], loadgen_args, args.start_delay)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,123 @@
+
+# Classification of request errors into integer codes, stored in the results tables instead of free-text messages.
+
+import errno, threading, time, zlib
+
+# HTTP errors are stored as their status code (400-599). Other kinds of errors:
+TIMEOUT = 1
+CONNECTION_REFUSED = 2
+CONNECTION_ERROR = 3
+AUTH_FAILURE = 4
+
+# Other exceptions get one code per exception class, derived from the class name so that
+# codes agree between processes and hosts.
+OTHER_BASE = 1000
+OTHER_RANGE = 1 << 20
+
+# Number of full messages stored per error code.
+SAMPLES_PER_CODE = 5
+
+# Minimum number of seconds between two log lines about the same error code.
+LOG_INTERVAL = 5.0
+
+CREATE_CODES_QUERY = "create table if not exists error_codes (code integer, kind text, name text, count integer);"
+CREATE_SAMPLES_QUERY = "create table if not exists error_samples (code integer, time real, message text);"
+
+def http_status(e):
+    """HTTP status of an exception from requests, aiohttp or the official OpenStack clients, or None."""
+    response = getattr(e, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None:
+        status = getattr(e, 'http_status', None) or getattr(e, 'status', None) or getattr(e, 'code', None)
+    if isinstance(status, int) and 100 <= status < 600:
+        return status
+    return None
+
+def is_connection_refused(e):
+    # Exceptions of requests and urllib3 wrap the socket error in their arguments
+    seen = set()
+    pending = [ e ]
+    while pending:
+        e = pending.pop()
+        if id(e) in seen:
+            continue
+        seen.add(id(e))
+        if getattr(e, 'errno', None) == errno.ECONNREFUSED:
+            return True
+        pending += [ arg for arg in getattr(e, 'args', ()) if isinstance(arg, BaseException) ]
+        for attr in ('reason', 'os_error', '__cause__', '__context__'):
+            inner = getattr(e, attr, None)
+            if isinstance(inner, BaseException):
+                pending.append(inner)
+    return False
+
+def classify(e):
+    """Return (code, kind, name) of an exception."""
+    names = [ klass.__name__ for klass in type(e).__mro__ ]
+    status = http_status(e)
+    if status is not None:
+        return status, "auth" if status in (401, 403) else "http", "HTTP %i" % status
+    if any([ 'Timeout' in name for name in names ]) or 'timeout' in names:
+        return TIMEOUT, "timeout", "Timeout"
+    if is_connection_refused(e):
+        return CONNECTION_REFUSED, "connection", "Connection refused"
+    if any([ name in ('AuthorizationFailure', 'Unauthorized', 'AuthenticationFailure') for name in names ]):
+        return AUTH_FAILURE, "auth", "Authentication failure"
+    if any([ 'ConnectionError' in name for name in names ]):
+        return CONNECTION_ERROR, "connection", "Connection error"
+    name = "%s.%s" % (type(e).__module__, type(e).__name__)
+    return OTHER_BASE + zlib.crc32(name.encode('utf-8')) % OTHER_RANGE, "other", name
+
+class ErrorTable(object):
+    """Thread-safe record of the errors of one test run: number of errors per code, the first SAMPLES_PER_CODE
+    full messages per code and rate-limited logging."""
+
+    def __init__(self, log):
+        self.log = log
+        self.lock = threading.Lock()
+        self.codes = {}
+        self.counts = {}
+        self.samples = []
+        self.logged = {}
+
+    def record(self, e):
+        """Classify and count an exception, return its code."""
+        code, kind, name = classify(e)
+        now = time.time()
+        message = None
+        with self.lock:
+            count = self.counts.get(code, 0) + 1
+            self.counts[code] = count
+            if count == 1:
+                self.codes[code] = (kind, name)
+            if count <= SAMPLES_PER_CODE:
+                message = "%s: %s" % (type(e).__name__, e)
+                self.samples.append((code, now, message))
+            last_time, last_count = self.logged.get(code, (None, 0))
+            log_now = last_time is None or now - last_time >= LOG_INTERVAL
+            if log_now:
+                self.logged[code] = (now, count)
+        if log_now:
+            suppressed = count - last_count - 1
+            if message is None:
+                message = "%s: %s" % (type(e).__name__, e)
+            self.log("Error %i (%s): %s%s" % (code, name, message,
+                " (%i more since last message)" % suppressed if suppressed > 0 else ""))
+        return code
+
+    def write(self, cursor):
+        """Store the error codes and sampled messages in the error_codes and error_samples tables."""
+        cursor.execute(CREATE_CODES_QUERY)
+        cursor.execute(CREATE_SAMPLES_QUERY)
+        with self.lock:
+            codes = [ (code, kind, name, self.counts[code]) for code, (kind, name) in sorted(self.codes.items()) ]
+            samples = list(self.samples)
+        cursor.executemany("insert into error_codes values (?, ?, ?, ?);", codes)
+        cursor.executemany("insert into error_samples values (?, ?, ?);", samples)
+
+def merge_codes(cursor):
+    """Combine rows of the same code in the error_codes table, e.g. after merging databases."""
+    cursor.execute("create temporary table merged_codes as select code, min(kind), min(name), sum(count) from error_codes group by code;")
+    cursor.execute("delete from error_codes;")
+    cursor.execute("insert into error_codes select * from merged_codes;")
+    cursor.execute("drop table merged_codes;")
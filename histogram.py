@@ -0,0 +1,156 @@
+
+# Fixed-memory latency histograms with logarithmic buckets, similar to HdrHistogram.
+
+import sys, json, math, sqlite3
+
+# Latencies are counted in integer microseconds.
+UNITS_PER_SECOND = 1000000
+
+# Latencies above this value (in seconds) are counted as this value.
+HIGHEST_LATENCY = 3600
+
+# Relative precision of bucket boundaries: 2 digits means an error below 1%.
+SIGNIFICANT_DIGITS = 2
+
+# Percentiles reported for every histogram.
+PERCENTILES = [ 50, 90, 99, 99.9 ]
+
+class LatencyHistogram(object):
+    """Counts latencies in buckets, which are linear within each power of two. Only non-empty buckets are stored,
+    their number is bounded by highest and digits. Histograms with the same highest and digits parameters can be merged."""
+
+    def __init__(self, highest=HIGHEST_LATENCY, digits=SIGNIFICANT_DIGITS):
+        self.highest = highest
+        self.digits = digits
+        self.sub_bucket_bits = int(math.ceil(math.log(2 * 10 ** digits, 2)))
+        self.sub_bucket_half = 1 << (self.sub_bucket_bits - 1)
+        self.highest_units = int(highest * UNITS_PER_SECOND)
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def index(self, units):
+        shift = max(0, units.bit_length() - self.sub_bucket_bits)
+        return shift * self.sub_bucket_half + (units >> shift)
+
+    def highest_equivalent(self, index):
+        """Largest value (in units) counted in the bucket with the given index."""
+        shift = max(0, index // self.sub_bucket_half - 1)
+        return ((index - shift * self.sub_bucket_half + 1) << shift) - 1
+
+    def record(self, latency, count=1):
+        """Count a latency given in seconds."""
+        units = min(max(int(latency * UNITS_PER_SECOND), 0), self.highest_units)
+        index = self.index(units)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        self.total += latency * count
+        if self.min is None or latency < self.min: self.min = latency
+        if self.max is None or latency > self.max: self.max = latency
+
+    def merge(self, other):
+        if (other.highest, other.digits) != (self.highest, self.digits):
+            raise Exception("Cannot merge histograms with different parameters.")
+        for i, count in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + count
+        self.add_totals(other.count, other.total, other.min, other.max)
+
+    def add_totals(self, count, total, minimum, maximum):
+        self.count += count
+        self.total += total
+        if minimum is not None and (self.min is None or minimum < self.min): self.min = minimum
+        if maximum is not None and (self.max is None or maximum > self.max): self.max = maximum
+
+    def percentile(self, percentile):
+        """Latency in seconds below or at which the given percentage of values lie. None if empty."""
+        if self.count == 0:
+            return None
+        limit = max(1, int(math.ceil(self.count * percentile / 100.0)))
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= limit:
+                value = float(self.highest_equivalent(i)) / UNITS_PER_SECOND
+                return min(value, self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        """Tuple of count, mean, all PERCENTILES and max."""
+        return (self.count, self.mean()) + tuple([ self.percentile(p) for p in PERCENTILES ]) + (self.max,)
+
+    def encode(self):
+        """Compact text representation, which only contains non-empty buckets."""
+        return json.dumps({
+            "highest": self.highest, "digits": self.digits,
+            "count": self.count, "total": self.total, "min": self.min, "max": self.max,
+            "counts": sorted(self.counts.items())
+        }, separators=(',', ':'))
+
+    @staticmethod
+    def decode(text):
+        data = json.loads(text)
+        h = LatencyHistogram(data["highest"], data["digits"])
+        for i, count in data["counts"]:
+            h.counts[i] = count
+        h.add_totals(data["count"], data["total"], data["min"], data["max"])
+        return h
+
+# Table holding one row per interval and one 'total' row per histogram name.
+CREATE_HISTOGRAMS_QUERY = "create table if not exists histograms (name text, scope text, start real, duration real, " \
+    "count integer, errors integer, mean real, p50 real, p90 real, p99 real, p999 real, max real, histogram text);"
+INSERT_HISTOGRAM_QUERY = "insert into histograms values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"
+
+def histogram_row(name, scope, start, duration, histogram, errors):
+    summary = histogram.summary()
+    return (name, scope, start, duration, summary[0], errors) + summary[1:] + (histogram.encode(),)
+
+def merge_histogram_rows(rows):
+    """Merge rows of the histograms table by name and scope. Intervals are matched by start,
+    the total rows of a name are combined into one covering all of them."""
+    merged = {}
+    for name, scope, start, duration, _, errors, _, _, _, _, _, _, text in rows:
+        key = (name, scope, start if scope == 'interval' else None)
+        histogram = LatencyHistogram.decode(text)
+        if key in merged:
+            m_start, m_duration, m_histogram, m_errors = merged[key]
+            end = max(m_start + m_duration, start + duration)
+            m_start = min(m_start, start)
+            m_histogram.merge(histogram)
+            merged[key] = (m_start, end - m_start, m_histogram, m_errors + errors)
+        else:
+            merged[key] = (start, duration, histogram, errors)
+    return [ histogram_row(name, scope, start, duration, histogram, errors)
+             for (name, scope, _), (start, duration, histogram, errors) in sorted(merged.items(), key=lambda x: (x[0][0], x[0][1], x[1][0])) ]
+
+def merge_histogram_table(cursor, schema="source"):
+    """Merge the histograms table of an attached database into the histograms table of the main database."""
+    cursor.execute(CREATE_HISTOGRAMS_QUERY)
+    rows = cursor.execute("select * from main.histograms").fetchall()
+    rows += cursor.execute("select * from %s.histograms" % schema).fetchall()
+    cursor.execute("delete from main.histograms")
+    cursor.executemany(INSERT_HISTOGRAM_QUERY, merge_histogram_rows(rows))
+
+def main(argv):
+    if len(argv) == 0:
+        print("Parameters: <sqlite3 database file>*")
+        print("Prints the latency percentiles of the whole run, merged over all given databases.")
+        return 1
+    rows = []
+    for db_file in argv:
+        conn = sqlite3.connect(db_file)
+        try:
+            rows += conn.execute("select * from histograms where scope = 'total'").fetchall()
+        finally:
+            conn.close()
+    print("name count errors mean %s max (seconds)" % " ".join([ "p%s" % p for p in PERCENTILES ]))
+    for row in merge_histogram_rows(rows):
+        print(" ".join([ str(x) for x in (row[:1] + row[4:-1]) ]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
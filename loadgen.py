@@ -1,13 +1,61 @@
 
-import sys, signal, sqlite3, time, os, threading, multiprocessing, argparse
+import sys, signal, sqlite3, time, os, threading, multiprocessing, argparse, random, collections, csv, math
+from functools import reduce
+import histogram
+import error_codes
+
+try:
+    # Python 2
+    import Queue as queue
+except ImportError:
+    # Python 3
+    import queue
 
 # Number of results to buffer before writing them to the database.
 BUFFERED_RESULTS = 400
 
+# Maximum number of seconds results are buffered before writing them to the database.
+FLUSH_INTERVAL = 1.0
+
+# Seconds the result writer sleeps while waiting for new results.
+WRITER_POLL_INTERVAL = 0.01
+
+# Length (in seconds) of the intervals of the latency statistics.
+STATISTICS_INTERVAL = 1.0
+
+# Seconds between two lines of live statistics.
+REPORT_INTERVAL = 1.0
+
+# Number of completed intervals kept in memory for the latency statistics.
+RECENT_INTERVALS = 3600
+
+# A step of the saturation search fails if less than this fraction of the target rate is achieved.
+SEARCH_MIN_ACHIEVED = 0.95
+
+# Seconds between two checks whether the requests of the previous search step or the statistics of a step completed.
+SEARCH_DRAIN_INTERVAL = 0.1
+
 # Number of threads creating requests. Requests-queue will stall if there are
 # not enough workers or if requests take too long to come back.
 NUM_WORKERS = 100
 
+# Default maximum number of requests in flight with the asyncio engine.
+ASYNC_CONCURRENCY = 10000
+
+# Seconds for the processes of --processes to create their request generators before starting in sync.
+PROCESS_START_DELAY = 5
+
+# Seconds before the intended start of a request at which the scheduled producer stops sleeping and
+# polls the clock instead, as sleeping may overshoot by more than the dispatch accuracy we aim for.
+DISPATCH_SPIN = 0.0005
+
+# Number of start times read from a trace at once, and number of such chunks read ahead of the dispatch.
+TRACE_CHUNK = 10000
+TRACE_CHUNKS_AHEAD = 4
+
+# Tables of results databases that do not hold requests.
+STATISTICS_TABLES = [ "histograms", "error_codes", "error_samples", "analyse_state" ]
+
 # Rate (in seconds) at which new request-jobs are added to the queue.
 # Determines the "granularity" of creating new requests
 BASE_PRODUCER_TIMEOUT = 0.2
@@ -58,7 +106,28 @@ def safe_tablename(string):
     pattern = re.compile('[\W_]+')
     return pattern.sub('', string)
 
-def main(argv):
+def table_name(create_query):
+    """Extract the table name from a 'create table' query."""
+    import re
+    match = re.match(r'\s*create\s+table\s+(?:if\s+not\s+exists\s+)?(\w+)', create_query, re.IGNORECASE)
+    if not match:
+        raise Exception("Cannot find table name in query: %s" % create_query)
+    return match.group(1)
+
+def extend_queries(create_query, commit_query, columns):
+    """Append (name, type) columns to a 'create table' query and its matching 'insert ... values' query."""
+    if not columns:
+        return create_query, commit_query
+    definitions = "".join([ ", %s %s" % column for column in columns ])
+    placeholders = ", ?" * len(columns)
+    i = create_query.rindex(')')
+    create_query = create_query[:i] + definitions + create_query[i:]
+    i = commit_query.rindex(')')
+    commit_query = commit_query[:i] + placeholders + commit_query[i:]
+    return create_query, commit_query
+
+def parse_args(argv):
+    """Parse and check the command line. Returns the arguments, or None after printing the problem."""
     parser = argparse.ArgumentParser(description='Execute certain requests and log the results to a sqlite file.')
     parser.add_argument('-k', '--klass', required=True, type=str, help='Fully qualified Python class to use as request generator. The class must subclass LoadGenerator and conform to a certain API.')
     parser.add_argument('-p', '--params', type=str, nargs='*', help='Parameters to pass to the request generator class in the form of key=value pairs. All values will be collected and passed to the constructor.')
@@ -67,13 +136,36 @@ def main(argv):
     parser.add_argument('-r', '--requests_per_second', default=2, type=int, help='Requests fired per second. Combined with -i, this is the initial requests-per-second value.')
     parser.add_argument('-i', '--requests_increment', default=0, type=int, help='Additional number of requests added each speedup-interval (set by -I).')
     parser.add_argument('-I', '--requests_increment_timeout', default=120, type=int, help='Number of seconds before increasing the requests per second. Only applied when -i is larger then zero.')
-    args = parser.parse_args()
+    parser.add_argument('-s', '--schedule', default='burst', choices=sorted(SCHEDULES.keys()), help='How request start times are planned. burst releases requests in chunks every %.1f seconds. constant and poisson give every request its own intended start time and record the dispatch lag in an additional lag column.' % BASE_PRODUCER_TIMEOUT)
+    parser.add_argument('--trace', type=str, help='Replay the start times of a recorded run instead of -r and -s: a results database (the start column of its results table) or a CSV file (the start column, or the first column without header) holding unix timestamps sorted by time. Requests are fired at the same offsets from the start of the run. The run ends after the trace, unless --trace_loop is given.')
+    parser.add_argument('--trace_table', type=str, help='Results table of the --trace database, if it has more than one.')
+    parser.add_argument('--trace_speed', default=1.0, type=float, help='Speed factor of --trace, e.g. 2 or 10 replays the trace two or ten times faster.')
+    parser.add_argument('--trace_loop', action='store_true', help='Replay --trace again and again, until the run is stopped.')
+    parser.add_argument('--smooth_ramp', action='store_true', help='With -i and a constant or poisson schedule, raise the rate with every request instead of in steps every -I seconds.')
+    parser.add_argument('-e', '--engine', default='threads', choices=['threads', 'asyncio'], help='threads executes requests in %i blocking worker threads. asyncio keeps all requests in flight in one event loop (Python 3, aiohttp, request generator must implement execute_request_async).' % NUM_WORKERS)
+    parser.add_argument('-c', '--concurrency', default=ASYNC_CONCURRENCY, type=int, help='Maximum number of requests in flight with the asyncio engine.')
+    parser.add_argument('-u', '--users', default=0, type=int, help='Closed-loop mode: number of virtual users, each executing requests back-to-back. Replaces -r and -s, -i then adds users every -I seconds.')
+    parser.add_argument('--think_time', default=0, type=float, help='Seconds each virtual user waits between two requests.')
+    parser.add_argument('--batch_size', default=BUFFERED_RESULTS, type=int, help='Number of buffered results that triggers a database write.')
+    parser.add_argument('--flush_interval', default=FLUSH_INTERVAL, type=float, help='Maximum number of seconds results are buffered before writing them to the database.')
+    parser.add_argument('--report_interval', default=REPORT_INTERVAL, type=float, help='Seconds between two lines of live statistics (achieved and target rate, requests in flight, error rate, latency percentiles). 0 disables the output.')
+    parser.add_argument('--stats_port', default=0, type=int, help='Serve the live statistics on this localhost port, as JSON on / and in Prometheus text format on /metrics.')
+    parser.add_argument('--search', action='store_true', help='Search the maximum request rate meeting --slo_p99 and --slo_error_rate. Starts at -r, each step lasts -I seconds. The rate is doubled until the SLO is violated, then bisected. The experiment stops when the result is known.')
+    parser.add_argument('--slo_p99', default=1000, type=float, help='Maximum 99th percentile latency in milliseconds for --search.')
+    parser.add_argument('--slo_error_rate', default=0.01, type=float, help='Maximum fraction of failed requests for --search.')
+    parser.add_argument('--search_resolution', default=1, type=float, help='--search stops when the sustainable rate is known up to this many requests per second.')
+    parser.add_argument('--search_warmup', default=5, type=float, help='Seconds at the beginning of every --search step that are not evaluated.')
+    parser.add_argument('--sample_rate', default=1.0, type=float, help='Fraction of successful results stored as rows, for long soak tests. Errors and results slower than --slow_threshold are always stored. Stored rows get a weight column (1/probability of being stored), the histograms table still covers all results.')
+    parser.add_argument('--slow_threshold', default=0, type=float, help='With --sample_rate, always store results with a latency of at least this many milliseconds. 0 disables.')
+    parser.add_argument('--sink', default='sqlite', choices=['sqlite', 'binary'], help='Where results are written. binary appends fixed-width records to <db>.bin (see binary_sink.py), the database then only holds the empty results table, histograms and other statistics. Export with analyse/binary_results.py.')
+    parser.add_argument('-P', '--processes', default=1, type=int, help='Number of processes generating load. Each process fires its share of -r and -i and writes a separate database, which are merged into the database given by -d at the end.')
+    args = parser.parse_args(argv)
     if args.params:
         for param in args.params:
             components = param.split('=')
             if len(components) != 2:
                 print("Illegal key=value parameter: %s" % param)
-                return 1
+                return None
             key, value = components
             setattr(args, key, value)
 
@@ -81,16 +173,72 @@ def main(argv):
     database_name = args.db or get_database_name()
     if os.path.exists(database_name):
         print("Database file %s already exists." % database_name)
-        return 1
+        return None
     args.db = database_name
+    if args.users > 0:
+        # Closed loop requests have no intended start time
+        args.schedule = 'burst'
+    elif args.engine == 'asyncio' and args.schedule == 'burst':
+        # The event loop dispatches every request individually
+        args.schedule = 'constant'
+
+    if args.users == 0 and not args.trace and args.requests_per_second <= 0:
+        print("-r must be positive, unless --users or --trace is given.")
+        return None
+    if not 0 < args.sample_rate <= 1:
+        print("--sample_rate must be larger than 0 and at most 1.")
+        return None
+    if args.trace:
+        if args.users > 0 or args.search or args.requests_increment > 0:
+            print("--trace cannot be combined with --users, --search or -i.")
+            return None
+        if args.trace_speed <= 0:
+            print("--trace_speed must be positive.")
+            return None
+        try:
+            # Fail early for missing files and tables
+            ReplaySchedule(args.trace, args.trace_table, start_reader=False)
+        except Exception as e:
+            print("Cannot replay %s: %s" % (args.trace, e))
+            return None
+        args.schedule = 'replay'
+    if args.search and (args.users > 0 or args.processes > 1):
+        print("--search cannot be combined with --users or --processes.")
+        return None
+    if args.search:
+        # Steps start at the beginning of a statistics interval, only complete intervals are evaluated
+        warmup = min(args.search_warmup, args.requests_increment_timeout / 2.0)
+        if math.floor(args.requests_increment_timeout / STATISTICS_INTERVAL) - math.ceil(warmup / STATISTICS_INTERVAL) < 1:
+            print("--search steps (-I) must contain at least one complete statistics interval of %g seconds after --search_warmup." % STATISTICS_INTERVAL)
+            return None
+    if args.sink == 'binary' and args.processes > 1:
+        print("--sink binary cannot be combined with --processes.")
+        return None
+    if args.processes > 1:
+        if args.users > 0 and args.users < args.processes:
+            print("Need at least one user for each of the %i processes." % args.processes)
+            return None
+        if args.users == 0 and not args.trace and args.requests_per_second < args.processes:
+            print("Need at least one request per second for each of the %i processes." % args.processes)
+            return None
+    return args
 
-    # ======== Create the request generator object
+def main(argv):
+    args = parse_args(argv)
+    if args is None:
+        return 1
+    if args.processes > 1:
+        return run_processes(args)
+    return run(args)
+
+def create_generator(args):
+    """Instantiate the request generator class given by args.klass. Returns None on errors."""
     import operator
     try:
         components = args.klass.split('.')
         if len(components) < 2:
             print("Request generator class not fully qualified class name: %s" % args.klass)
-            return 1
+            return None
         classname = components[-1]
         mod = __import__(reduce(operator.concat, components[:-1]), fromlist=[classname])
         klass = getattr(mod, classname)
@@ -100,54 +248,201 @@ def main(argv):
         print(e)
         import traceback
         traceback.print_exc()
+        return None
+    if args.engine == 'asyncio' and not hasattr(l, 'execute_request_async'):
+        print("Request generator class %s does not support the asyncio engine" % args.klass)
+        return None
+    return l
+
+def run(args):
+    """Generate load in the current process until SIGINT or the timeout."""
+    l = create_generator(args)
+    if l is None:
         return 1
 
+    # ======== Set up termination before any thread can stop the run
+    def signal_handler(signum, frame):
+        log("Signal %s caught." % signum)
+        l.stop_running()
+    signal.signal(signal.SIGINT, signal_handler)
+
     # ======== Create and start worker threads
     log("Running against %s" % l.auth_url)
-    log("Running with %i requests per second" % args.requests_per_second)
+    if args.users > 0:
+        log("Running closed loop with %i users, %.2f seconds think time" % (args.users, args.think_time))
+    elif args.trace:
+        log("Replaying %s at %gx speed%s" % (args.trace, args.trace_speed, ", looped" if args.trace_loop else ""))
+    else:
+        log("Running with %i requests per second" % args.requests_per_second)
     log("Starting worker threads...")
-    l.set_requests_per_second(args.requests_per_second)
-    l.create_production_worker()
-    if args.requests_increment > 0:
-        log("Incrementing requests_per_second by %i every %i seconds" % (args.requests_increment, args.requests_increment_timeout))
-        l.production_speedup_increment = args.requests_increment
-        l.production_speedup_timeout = args.requests_increment_timeout
-        l.start_production_speedup_worker()
-    for _ in range(NUM_WORKERS):
-        l.create_execution_worker()
+    if args.trace:
+        l.set_schedule(ReplaySchedule(args.trace, args.trace_table, args.trace_speed, args.trace_loop,
+            getattr(args, 'trace_shard', None)))
+    elif args.schedule != 'burst':
+        log("Using %s schedule" % args.schedule)
+        l.set_schedule(SCHEDULES[args.schedule](args.requests_per_second))
+    if args.users == 0 and not args.trace:
+        # Closed-loop users and the trace set the rate themselves
+        l.set_requests_per_second(args.requests_per_second)
+    l.think_time = args.think_time
+    if args.engine == 'asyncio':
+        import loadgen_async
+        log("Using asyncio engine with up to %i concurrent requests" % args.concurrency)
+        loadgen_async.AsyncEngine(l, args.concurrency).create_thread()
+    elif args.users == 0:
+        l.create_production_worker()
+        for _ in range(NUM_WORKERS):
+            l.create_execution_worker()
+    start_at = getattr(args, 'start_at', None)
+    if start_at is not None:
+        delay = start_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            log("Starting %.2f seconds late" % -delay)
+    if args.users > 0:
+        l.set_users(args.users)
+    if args.search:
+        search = SaturationSearch(l, args.requests_per_second, args.requests_increment_timeout,
+            args.slo_p99 / 1000.0, args.slo_error_rate, args.search_resolution, args.search_warmup)
+        l.threads.append(threading.Thread(target = search.run))
+    elif args.requests_increment > 0:
+        if args.users > 0:
+            log("Adding %i users every %i seconds" % (args.requests_increment, args.requests_increment_timeout))
+            l.production_speedup_increment = args.requests_increment
+            l.production_speedup_timeout = args.requests_increment_timeout
+            l.start_production_speedup_worker()
+        elif args.smooth_ramp and l.schedule is not None:
+            log("Incrementing requests_per_second smoothly by %i every %i seconds" % (args.requests_increment, args.requests_increment_timeout))
+            l.schedule.set_ramp(float(args.requests_increment) / args.requests_increment_timeout)
+        else:
+            log("Incrementing requests_per_second by %i every %i seconds" % (args.requests_increment, args.requests_increment_timeout))
+            l.production_speedup_increment = args.requests_increment
+            l.production_speedup_timeout = args.requests_increment_timeout
+            l.start_production_speedup_worker()
     starttime = time.time()
     for thread in l.threads:
         thread.daemon = True
         thread.start()
+    reporter = StatisticsReporter(l, args.report_interval, args.stats_port)
+    reporter.start()
 
-    # ======== Set up termination
     if args.timeout > 0:
-        def kill_self():
-            own_pid = multiprocessing.current_process().pid
-            log("Sending SIGINT to current process (%i)" % own_pid)
-            os.kill(own_pid, signal.SIGINT)
+        def timeout():
+            log("Timeout of %i seconds reached" % args.timeout)
+            l.stop_running()
         log("Terminating automatically after %i seconds..." % args.timeout)
-        timer = threading.Timer(args.timeout, kill_self)
+        timer = threading.Timer(args.timeout, timeout)
         timer.daemon = True
         timer.start()
     log("Press CTRL-C to interrupt (or kill -INT ...)...")
-    def signal_handler(signum, frame):
-        log("Signal %s caught." % signum)
-        l.stop_running()
-    signal.signal(signal.SIGINT, signal_handler)
-    # Wait for SIGINT from outside or from timer
-    signal.pause()
+    # Wait for SIGINT from outside, the timer, the end of the schedule or the search.
+    # The timeout keeps the main thread responsive to signals.
+    while not l.stopped.wait(1.0):
+        pass
 
     # ======== Wait for threads and write last results
     l.finish_workers()
     l.flush_results()
+    reporter.stop()
+    l.cleanup()
 
     # ======== Output some lowlevel statistics
-    duration = l.last_request_end - starttime
+    duration = max(l.last_request_end - starttime, 0)
     seconds_per_req = duration*1000/l.request_nr if l.request_nr > 0 else 0
-    reqs_per_second = l.request_nr/duration
+    reqs_per_second = l.request_nr/duration if duration > 0 else 0
     log("Executed %i requests in %.2f seconds. %.2f requests per second, %.2f milliseconds per request." \
                 % (l.request_nr, duration, reqs_per_second, seconds_per_req))
+    if l.sample_rate < 1:
+        log("Stored %i of %i results (sample rate %g, errors and results slower than %g ms always)." \
+                % (l.results_stored, l.request_nr, l.sample_rate, l.slow_threshold * 1000))
+    if l.statistics.total.count > 0:
+        log("Latency of %i successful requests: %s" % (l.statistics.total.count, ", ".join(
+            [ "p%s %.2f ms" % (p, l.statistics.total.percentile(p)*1000) for p in histogram.PERCENTILES ]
+            + [ "max %.2f ms" % (l.statistics.total.max*1000) ])))
+    return 0
+
+def share(total, parts, index):
+    """Split the integer total into parts, return the share of part index."""
+    return total // parts + (1 if index < total % parts else 0)
+
+def run_shard(args):
+    # Forked processes inherit the state of the random module
+    random.seed()
+    sys.exit(run(args))
+
+def run_processes(args):
+    """Run one load generating process per shard of the request rate and merge their databases."""
+    import copy
+    # All processes start at the same instant, so the merged results share one time base.
+    # In open-loop mode, process i is delayed by i/n of a request interval, so constant schedules interleave.
+    start_at = time.time() + PROCESS_START_DELAY
+    shard_args = []
+    for i in range(args.processes):
+        a = copy.copy(args)
+        a.db = "%s.shard%i" % (args.db, i)
+        a.requests_per_second = share(args.requests_per_second, args.processes, i)
+        a.requests_increment = share(args.requests_increment, args.processes, i)
+        a.users = share(args.users, args.processes, i)
+        a.start_at = start_at
+        if args.trace:
+            # Every process replays every n-th request of the trace, from the same start. The trace sets the rate.
+            a.trace_shard = (i, args.processes)
+            a.requests_per_second = args.requests_per_second
+        elif args.users == 0:
+            a.start_at += float(i) / args.requests_per_second
+        if os.path.exists(a.db):
+            print("Database file %s already exists." % a.db)
+            return 1
+        shard_args.append(a)
+    log("Starting %i processes..." % args.processes)
+    processes = [ multiprocessing.Process(target=run_shard, args=(a,)) for a in shard_args ]
+    for process in processes:
+        process.start()
+    def signal_handler(signum, frame):
+        log("Signal %s caught, forwarding to %i processes." % (signum, len(processes)))
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+    signal.signal(signal.SIGINT, signal_handler)
+    for process in processes:
+        process.join()
+    failed = [ p for p in processes if p.exitcode != 0 ]
+    if failed:
+        log("%i processes failed, keeping their databases: %s" % (len(failed), ", ".join([ a.db for a in shard_args ])))
+        return 1
+
+    # ======== Merge the results of all processes
+    shards = [ a.db for a in shard_args if os.path.exists(a.db) ]
+    log("Merging %i databases into %s" % (len(shards), args.db))
+    merge_databases(args.db, shards)
+    for shard in shards:
+        os.remove(shard)
+    return 0
+
+def merge_databases(target, sources):
+    """Copy all tables of the source databases into the target database, creating missing tables.
+    Latency histograms of the same interval and counts of the same error code are merged."""
+    connection = sqlite3.connect(target)
+    try:
+        c = connection.cursor()
+        for source in sources:
+            c.execute("attach database ? as source", (source,))
+            tables = c.execute("select name, sql from source.sqlite_master where type = 'table'").fetchall()
+            for name, sql in tables:
+                if name == 'histograms':
+                    histogram.merge_histogram_table(c, "source")
+                    continue
+                exists = c.execute("select count(*) from main.sqlite_master where type = 'table' and name = ?", (name,)).fetchone()[0]
+                if not exists:
+                    c.execute(sql)
+                c.execute("insert into main.%s select * from source.%s" % (name, name))
+                if name == 'error_codes':
+                    error_codes.merge_codes(c)
+            connection.commit()
+            c.execute("detach database source")
+    finally:
+        connection.close()
 
 class DatabaseConnection(object):
     def __init__(self, generator, description="<unknown>", fatal=False):
@@ -175,8 +470,590 @@ class DatabaseConnection(object):
             log("Fatal error, exiting.")
             sys.exit(1)
 
+class ResultWriter(object):
+    """Background thread writing the results buffered by record_results to the database.
+    Keeps one connection open and writes when batch_size results are waiting or flush_interval seconds have passed."""
+
+    def __init__(self, generator, batch_size=BUFFERED_RESULTS, flush_interval=FLUSH_INTERVAL):
+        self.generator = generator
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.running = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Write all remaining results and wait for the writer thread."""
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        connection = sqlite3.connect(self.generator.database_name)
+        try:
+            connection.execute("pragma journal_mode=wal")
+            connection.execute("pragma synchronous=normal")
+            last_flush = time.time()
+            while True:
+                # Read the flag first, so results recorded before stop() are always written
+                running = self.running
+                if not running or len(self.generator.results) >= self.batch_size or time.time() - last_flush >= self.flush_interval:
+                    self.write(connection, self.drain())
+                    last_flush = time.time()
+                    if not running:
+                        self.write_histograms(connection, self.generator.statistics.complete(None))
+                        break
+                    self.write_histograms(connection, self.generator.statistics.complete(last_flush))
+                else:
+                    time.sleep(WRITER_POLL_INTERVAL)
+        finally:
+            connection.close()
+
+    def drain(self):
+        results = self.generator.results
+        with self.generator.results_lock:
+            values = [ results.popleft() for _ in range(len(results)) ]
+            self.generator.request_nr += len(values)
+        return values
+
+    def write(self, connection, values):
+        if len(values) > 0:
+            statistics = self.generator.statistics
+            for row in values:
+                statistics.add(*self.generator.result_summary(row))
+            values = self.generator.sample_results(values)
+            if not values:
+                return
+            try:
+                self.generator.commit_results(connection, values)
+                connection.commit()
+            except Exception as e:
+                log("Error during updating values: %s" % e)
+
+    def write_histograms(self, connection, rows):
+        if len(rows) > 0:
+            try:
+                connection.executemany(histogram.INSERT_HISTOGRAM_QUERY, rows)
+                connection.commit()
+            except Exception as e:
+                log("Error during updating histograms: %s" % e)
+
+class LatencyStatistics(object):
+    """Latency histograms per interval and of the whole run, fed by the result writer thread.
+    Intervals are assigned by request end time and are complete once no more results can arrive for them."""
+
+    def __init__(self, name, interval=STATISTICS_INTERVAL, delay=FLUSH_INTERVAL):
+        self.name = name
+        self.interval = interval
+        # Seconds after the end of an interval until all its results have passed the writer
+        self.delay = delay + interval
+        self.total = histogram.LatencyHistogram()
+        self.errors = 0
+        self.start = self.end = None
+        self.open = {}
+        # (start, histogram, errors) of the most recent complete intervals
+        self.recent = collections.deque(maxlen=RECENT_INTERVALS)
+        self.last_interval = None
+        # All intervals ending before this time are complete
+        self.complete_until = None
+
+    def add(self, start, latency, error):
+        end = start + latency
+        if self.start is None or start < self.start: self.start = start
+        if self.end is None or end > self.end: self.end = end
+        index = int(end // self.interval)
+        if index not in self.open:
+            self.open[index] = [ histogram.LatencyHistogram(), 0 ]
+        entry = self.open[index]
+        if error is None:
+            entry[0].record(latency)
+            self.total.record(latency)
+        else:
+            entry[1] += 1
+            self.errors += 1
+
+    def complete(self, now):
+        """Return histogram table rows for the intervals completed at time now. None completes all intervals
+        and adds the row of the whole run."""
+        rows = []
+        for index in sorted(self.open):
+            start = index * self.interval
+            if now is not None and start + self.interval + self.delay > now:
+                break
+            h, errors = self.open.pop(index)
+            self.last_interval = (start, h, errors)
+            self.recent.append(self.last_interval)
+            rows.append(histogram.histogram_row(self.name, 'interval', start, self.interval, h, errors))
+        if now is not None:
+            self.complete_until = now - self.delay
+        if now is None and self.start is not None:
+            rows.append(histogram.histogram_row(self.name, 'total', self.start, self.end - self.start, self.total, self.errors))
+        return rows
+
+    def window(self, start, end):
+        """Merged histogram, number of errors and covered duration of the recent complete intervals between start and end."""
+        first = math.ceil(start / self.interval) * self.interval
+        last = math.floor(end / self.interval) * self.interval
+        h = histogram.LatencyHistogram()
+        errors = 0
+        for interval_start, interval_histogram, interval_errors in list(self.recent):
+            if interval_start >= first and interval_start < last:
+                h.merge(interval_histogram)
+                errors += interval_errors
+        return h, errors, max(0, last - first)
+
+class SaturationSearch(object):
+    """Searches the highest request rate meeting a latency and error rate SLO. The rate is doubled until a step
+    violates the SLO, then the interval between the best passing and the worst failing rate is bisected.
+    Every step is stored in the search_steps table, the result in search_result."""
+
+    create_steps_query = "create table if not exists search_steps (step integer, start real, duration real, target_rps real, " \
+        "achieved_rps real, count integer, errors integer, error_rate real, p50 real, p99 real, max real, ok integer);"
+    create_result_query = "create table if not exists search_result (klass text, max_rps real, slo_p99 real, slo_error_rate real);"
+
+    def __init__(self, generator, start_rate, step_duration, slo_p99, slo_error_rate, resolution=1, warmup=0):
+        self.generator = generator
+        self.rate = float(start_rate)
+        self.step_duration = step_duration
+        self.slo_p99 = slo_p99
+        self.slo_error_rate = slo_error_rate
+        self.resolution = resolution
+        self.warmup = min(warmup, step_duration / 2.0)
+        self.passed = None
+        self.failed = None
+
+    def run(self):
+        g = self.generator
+        with g.connection(description="creating search tables") as c:
+            c.execute(self.create_steps_query)
+            c.execute(self.create_result_query)
+        step = 0
+        while g.workers_running:
+            log("Search step %i: %.1f requests per second" % (step, self.rate))
+            # The backlog of an overloaded step must not count for the next step
+            g.paused = True
+            self.drain()
+            start = self.align()
+            g.set_requests_per_second(self.rate)
+            g.paused = False
+            self.sleep(self.step_duration)
+            self.wait_for_statistics(start + self.step_duration)
+            if not g.workers_running:
+                break
+            ok = self.evaluate(step, start + self.warmup, start + self.step_duration)
+            if ok:
+                self.passed = self.rate
+            else:
+                self.failed = self.rate
+            step += 1
+            next_rate = self.next_rate()
+            if next_rate is None:
+                break
+            self.rate = next_rate
+        if self.passed is None:
+            log("No request rate met the SLO (p99 <= %.1f ms, error rate <= %.2f%%)" % (self.slo_p99 * 1000, self.slo_error_rate * 100))
+        else:
+            log("Maximum sustainable rate for %s: %.1f requests per second" % (g.args.klass, self.passed))
+        with g.connection(description="writing search result") as c:
+            c.execute("insert into search_result values (?, ?, ?, ?);", (g.args.klass, self.passed, self.slo_p99, self.slo_error_rate))
+        g.stop_running()
+
+    def drain(self):
+        """Wait until all released requests completed, at most twice the step duration. Production must be paused."""
+        g = self.generator
+        released = g.requests_released
+        backlog = released - g.completed_requests()
+        if backlog <= 0:
+            return
+        log("Waiting for %i requests of the previous step..." % backlog)
+        end = time.time() + 2 * self.step_duration
+        while g.workers_running and g.completed_requests() < released:
+            if time.time() > end:
+                log("%i requests of the previous step still outstanding, starting the step" % (released - g.completed_requests()))
+                return
+            time.sleep(SEARCH_DRAIN_INTERVAL)
+
+    def align(self):
+        """Wait for the beginning of the next statistics interval and return it, so steps cover whole intervals."""
+        interval = self.generator.statistics.interval
+        start = math.ceil(time.time() / interval) * interval
+        self.sleep(start - time.time())
+        return start
+
+    def wait_for_statistics(self, end):
+        """Wait until the result writer completed all statistics intervals ending before end."""
+        statistics = self.generator.statistics
+        while self.generator.workers_running and (statistics.complete_until is None or statistics.complete_until < end):
+            time.sleep(SEARCH_DRAIN_INTERVAL)
+
+    def sleep(self, seconds):
+        end = time.time() + seconds
+        while self.generator.workers_running and time.time() < end:
+            time.sleep(max(0, min(1, end - time.time())))
+
+    def evaluate(self, step, start, end):
+        h, errors, duration = self.generator.statistics.window(start, end)
+        total = h.count + errors
+        achieved = total / duration if duration > 0 else 0
+        error_rate = float(errors) / total if total > 0 else None
+        p50, p99 = h.percentile(50), h.percentile(99)
+        ok = total > 0 and error_rate <= self.slo_error_rate and p99 is not None and p99 <= self.slo_p99 \
+            and achieved >= SEARCH_MIN_ACHIEVED * self.rate
+        log("Search step %i %s: %.1f requests per second achieved, error rate %.2f%%, p99 %s ms" % (step,
+            "passed" if ok else "failed", achieved, (error_rate or 0) * 100, "-" if p99 is None else "%.1f" % (p99 * 1000)))
+        with self.generator.connection(description="writing search step") as c:
+            c.execute("insert into search_steps values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+                (step, start, duration, self.rate, achieved, total, errors, error_rate, p50, p99, h.max, int(ok)))
+        return ok
+
+    def next_rate(self):
+        """Rate of the next step, None when the search is finished."""
+        if self.failed is None:
+            return self.rate * 2
+        if self.passed is None:
+            if self.failed <= self.resolution:
+                return None
+            return self.failed / 2
+        if self.failed - self.passed <= self.resolution:
+            return None
+        return (self.passed + self.failed) / 2
+
+class StatisticsReporter(object):
+    """Thread computing live statistics of a LoadGenerator every interval. Prints them and optionally serves them
+    on a localhost HTTP port. Latency and error rate are taken from the most recent complete statistics interval."""
+
+    def __init__(self, generator, interval=REPORT_INTERVAL, port=0):
+        self.generator = generator
+        self.interval = interval
+        self.port = port
+        self.current = {}
+        self.server = None
+
+    def start(self):
+        if self.interval > 0:
+            thread = threading.Thread(target = self.run)
+            thread.daemon = True
+            thread.start()
+        if self.port:
+            self.start_server()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+
+    def run(self):
+        g = self.generator
+        start = last_time = time.time()
+        last_completed = g.completed_requests()
+        while g.workers_running:
+            time.sleep(self.interval)
+            now = time.time()
+            completed = g.completed_requests()
+            stats = {
+                "time": now,
+                "elapsed": now - start,
+                "requests_per_second": (completed - last_completed) / (now - last_time),
+                "target_requests_per_second": g.requests_per_second() if g.active_users is None else None,
+                "users": g.active_users,
+                "in_flight": g.requests_released - completed,
+                "completed": completed,
+                "error_rate": None,
+                "latency": {},
+            }
+            last_time, last_completed = now, completed
+            if g.statistics.last_interval is not None:
+                interval_start, h, errors = g.statistics.last_interval
+                if h.count + errors > 0:
+                    stats["error_rate"] = float(errors) / (h.count + errors)
+                for p in histogram.PERCENTILES:
+                    stats["latency"]["p%s" % p] = h.percentile(p)
+                stats["latency"]["max"] = h.max
+                stats["latency_interval_start"] = interval_start
+            self.current = stats
+            if g.workers_running:
+                log(self.format(stats))
+
+    def format(self, stats):
+        def ms(seconds):
+            return "-" if seconds is None else "%.1f" % (seconds * 1000)
+        error_rate = "-" if stats["error_rate"] is None else "%.2f%%" % (stats["error_rate"] * 100)
+        latency = " ".join([ "%s %s" % (name, ms(stats["latency"][name]))
+                             for name in [ "p%s" % p for p in histogram.PERCENTILES ] + [ "max" ] if name in stats["latency"] ])
+        if stats["users"] is None:
+            target = "target %.1f" % stats["target_requests_per_second"]
+        else:
+            target = "%i users" % stats["users"]
+        return "%.0fs: %.1f rps (%s), %i in flight, errors %s, latency ms: %s" % \
+            (stats["elapsed"], stats["requests_per_second"], target, stats["in_flight"], error_rate, latency or "-")
+
+    def prometheus(self, stats):
+        latency = stats.get("latency", {})
+        metrics = [
+            ("requests_per_second", "gauge", [ ("", stats.get("requests_per_second")) ]),
+            ("target_requests_per_second", "gauge", [ ("", stats.get("target_requests_per_second")) ]),
+            ("in_flight", "gauge", [ ("", stats.get("in_flight")) ]),
+            ("users", "gauge", [ ("", stats.get("users")) ]),
+            ("completed", "counter", [ ("", stats.get("completed")) ]),
+            ("error_rate", "gauge", [ ("", stats.get("error_rate")) ]),
+            ("latency_seconds", "gauge", [ ('{quantile="%s"}' % (p / 100.0), latency.get("p%s" % p)) for p in histogram.PERCENTILES ]),
+            ("latency_max_seconds", "gauge", [ ("", latency.get("max")) ]),
+        ]
+        lines = []
+        for name, kind, samples in metrics:
+            samples = [ (labels, value) for labels, value in samples if value is not None ]
+            if samples:
+                lines.append("# TYPE loadgen_%s %s" % (name, kind))
+                lines += [ "loadgen_%s%s %r" % (name, labels, float(value)) for labels, value in samples ]
+        return "\n".join(lines) + "\n"
+
+    def start_server(self):
+        import json
+        try:
+            # Python 2
+            from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+        except ImportError:
+            # Python 3
+            from http.server import HTTPServer, BaseHTTPRequestHandler
+        reporter = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = reporter.prometheus(reporter.current), "text/plain; version=0.0.4"
+                elif self.path == '/':
+                    body, content_type = json.dumps(reporter.current), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                pass
+        self.server = HTTPServer(('127.0.0.1', self.port), Handler)
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        log("Serving live statistics on http://127.0.0.1:%i/ and /metrics" % self.port)
+
+def sleep_until(deadline):
+    """Sleep until shortly before deadline, then poll the clock. The polling loop yields to other threads."""
+    delay = deadline - time.time() - DISPATCH_SPIN
+    if delay > 0:
+        time.sleep(delay)
+    while time.time() < deadline:
+        time.sleep(0)
+
+class Schedule(object):
+    """Open-loop schedule handing out the intended start time of every single request.
+    Rate changes take effect with the next request."""
+
+    def __init__(self, requests_per_second):
+        self.next_start = None
+        self.ramp = 0.0
+        self.set_requests_per_second(requests_per_second)
+
+    def set_requests_per_second(self, requests_per_second):
+        self.rate = float(requests_per_second)
+        self.rate_start = self.next_start
+
+    def requests_per_second(self):
+        if self.ramp and self.rate_start is not None:
+            return self.rate + self.ramp * (self.next_start - self.rate_start)
+        return self.rate
+
+    def set_ramp(self, ramp):
+        """Increase the rate by ramp requests per second, every second."""
+        self.ramp = float(ramp)
+
+    def start(self, now):
+        self.next_start = now
+        self.rate_start = now
+
+    def next_time(self):
+        """Return the intended start time of the next request."""
+        intended = self.next_start
+        self.next_start += self.interval(self.requests_per_second())
+        return intended
+
+    def interval(self, rate):
+        raise NotImplementedError("Subclasses must implement interval method")
+
+class ConstantSchedule(Schedule):
+    """Evenly spaced requests."""
+    def interval(self, rate):
+        return 1.0 / rate
+
+class PoissonSchedule(Schedule):
+    """Exponentially distributed gaps between requests, as for independent clients."""
+    def interval(self, rate):
+        return random.expovariate(rate)
+
+class ReplaySchedule(Schedule):
+    """Start times of a recorded run, read from a results database or a CSV file by a background thread, a few
+    chunks ahead of the dispatch, so that large traces are streamed instead of loaded. Requests keep their offsets
+    from the first start time, divided by speed. With loop, the trace starts again one average request interval
+    after its last request. shard (i, n) selects every n-th request, starting with request i.
+    next_time() returns None after the end of the trace."""
+
+    def __init__(self, path, table=None, speed=1.0, loop=False, shard=None, start_reader=True):
+        self.path = path
+        self.speed = float(speed)
+        self.loop = loop
+        self.shard = shard
+        self.is_csv = not self.is_database(path)
+        self.table = None if self.is_csv else self.find_table(path, table)
+        self.chunks = queue.Queue(TRACE_CHUNKS_AHEAD)
+        self.current = collections.deque()
+        self.rate = 0.0
+        self.next_start = None
+        self.finished = False
+        if start_reader:
+            thread = threading.Thread(target = self.read)
+            thread.daemon = True
+            thread.start()
+
+    @staticmethod
+    def is_database(path):
+        with open(path, "rb") as f:
+            return f.read(16) == b"SQLite format 3\x00"
+
+    @staticmethod
+    def find_table(path, table):
+        connection = sqlite3.connect(path)
+        try:
+            c = connection.cursor()
+            tables = [ row[0] for row in c.execute("select name from sqlite_master where type = 'table'") ]
+            tables = [ t for t in tables if t not in STATISTICS_TABLES and
+                'start' in [ row[1] for row in c.execute("pragma table_info(%s)" % safe_tablename(t)) ] ]
+        finally:
+            connection.close()
+        if table is not None:
+            if table not in tables:
+                raise Exception("No table %s with a start column, tables: %s" % (table, ", ".join(tables)))
+            return table
+        if len(tables) != 1:
+            raise Exception("Need --trace_table to choose one of the tables %s" % ", ".join(tables) if tables else "No table with a start column")
+        return tables[0]
+
+    def read_times(self):
+        """Generator of chunks of start times, in one pass over the trace."""
+        if self.is_csv:
+            with open(self.path) as f:
+                rows = csv.reader(f)
+                column = 0
+                chunk = []
+                for i, row in enumerate(rows):
+                    if not row:
+                        continue
+                    try:
+                        chunk.append(float(row[column]))
+                    except ValueError:
+                        if i > 0:
+                            raise
+                        # Header line
+                        if 'start' in row:
+                            column = row.index('start')
+                        continue
+                    if len(chunk) == TRACE_CHUNK:
+                        yield chunk
+                        chunk = []
+                if chunk:
+                    yield chunk
+        else:
+            connection = sqlite3.connect(self.path)
+            try:
+                c = connection.cursor()
+                c.execute("select start from %s where start is not null order by start" % safe_tablename(self.table))
+                while True:
+                    chunk = [ row[0] for row in c.fetchmany(TRACE_CHUNK) ]
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                connection.close()
+
+    def read(self):
+        """Put chunks of offsets from the start of the replay (before scaling) into the chunks queue, None at the end."""
+        offset = 0.0
+        index = 0
+        try:
+            while True:
+                first = last = None
+                count = 0
+                for chunk in self.read_times():
+                    if first is None:
+                        first = chunk[0]
+                    offsets = []
+                    for t in chunk:
+                        if self.shard is None or index % self.shard[1] == self.shard[0]:
+                            offsets.append(offset + t - first)
+                        index += 1
+                    if offsets:
+                        self.chunks.put(offsets)
+                    last = chunk[-1]
+                    count += len(chunk)
+                if not self.loop or count == 0:
+                    break
+                offset += last - first + ((last - first) / (count - 1) if count > 1 else 1.0)
+        except Exception as e:
+            log("Error reading %s: %s" % (self.path, e))
+        self.chunks.put(None)
+
+    def set_requests_per_second(self, requests_per_second):
+        # The trace determines the rate
+        pass
+
+    def requests_per_second(self):
+        return self.rate
+
+    def set_ramp(self, ramp):
+        pass
+
+    def start(self, now):
+        # Do not count waiting for the first chunk as lag
+        self.next_chunk()
+        self.start_time = max(now, time.time())
+
+    def next_chunk(self):
+        chunk = None if self.finished else self.chunks.get()
+        if chunk is None:
+            self.finished = True
+            return
+        self.current.extend(chunk)
+        # Rate of the chunk, for the live statistics
+        if len(chunk) > 1 and chunk[-1] > chunk[0]:
+            self.rate = (len(chunk) - 1) * self.speed / (chunk[-1] - chunk[0])
+
+    def next_time(self):
+        if not self.current:
+            self.next_chunk()
+            if not self.current:
+                return None
+        intended = self.start_time + self.current.popleft() / self.speed
+        # Start times of a trace that is not sorted are dispatched in order
+        if self.next_start is not None and intended < self.next_start:
+            intended = self.next_start
+        self.next_start = intended
+        return intended
+
+# Values of the --schedule option. burst is the chunked producer of LoadGenerator.
+SCHEDULES = {
+    'burst': None,
+    'constant': ConstantSchedule,
+    'poisson': PoissonSchedule,
+}
+
 class LoadGenerator(object):
 
+    # Additional (name, type) columns appended to every row by record_results.
+    # Values are set per request with set_result_value.
+    result_columns = ()
+
     def __init__(self, args):
         self.args = args
         if self.commit_query is None:
@@ -184,73 +1061,150 @@ class LoadGenerator(object):
         if self.create_query is None:
             raise Exception("Need non-abstract subclass with create_query attribute!")
 
+        self.extra_columns = list(self.result_columns)
+        if getattr(args, 'schedule', 'burst') != 'burst':
+            # Difference between intended and actual start of each request
+            self.extra_columns.append(("lag", "real"))
+        self.create_query, self.commit_query = extend_queries(self.create_query, self.commit_query, self.extra_columns)
+
+        # Downsampling: successful results are stored with probability sample_rate, errors and slow results always.
+        # Stored rows carry their weight (1/probability), so weighted sums estimate the totals.
+        self.sample_rate = getattr(args, 'sample_rate', 1.0)
+        self.slow_threshold = getattr(args, 'slow_threshold', 0) / 1000.0
+        self.results_stored = 0
+        if self.sample_rate < 1:
+            self.create_query, self.commit_query = extend_queries(self.create_query, self.commit_query, [ ("weight", "real") ])
+        self.local = threading.local()
+
         self.database_name = args.db
         log("Writing to database %s" % self.database_name)
 
         # Create table for our measurements
         with self.connection(description="creating table", fatal=True) as c:
             c.execute(self.create_query)
+            c.execute(histogram.CREATE_HISTOGRAMS_QUERY)
+            column_types = [ (row[1], row[2]) for row in c.execute("pragma table_info(%s)" % table_name(self.create_query)) ]
 
-        # Collection of data, shared array guarded by lock
-        self.results = []
+        # Optionally write results to a binary file instead of the table
+        self.result_sink = None
+        if getattr(args, 'sink', 'sqlite') == 'binary':
+            import binary_sink
+            path = self.database_name + ".bin"
+            log("Writing results to %s" % path)
+            self.result_sink = binary_sink.BinaryResultSink(path, table_name(self.create_query), self.create_query, column_types)
+
+        # Collection of data. Appending to the deque is thread-safe, only the writer thread removes results.
+        # The lock is only used to count results consistently while the writer removes them.
+        self.results = collections.deque()
         self.results_lock = threading.Lock()
-        self.results_buffer = BUFFERED_RESULTS
 
-        # Some statistics
+        # Some statistics. request_nr counts results taken by the writer, requests_released is only
+        # incremented by the thread releasing requests.
         self.request_nr = 0
+        self.requests_released = 0
         self.last_request_end = 0
 
+        # Errors are recorded as integer codes, messages are sampled and logged rate-limited
+        self.errors = error_codes.ErrorTable(log)
+
+        self.statistics = LatencyStatistics(table_name(self.create_query),
+            delay=getattr(args, 'flush_interval', FLUSH_INTERVAL))
+        self.writer = ResultWriter(self,
+            getattr(args, 'batch_size', BUFFERED_RESULTS),
+            getattr(args, 'flush_interval', FLUSH_INTERVAL))
+        self.writer.start()
+
         # Workers
         self.workers_running = True
         self.threads = []
+        # Set by stop_running, run() waits for it
+        self.stopped = threading.Event()
+        self.stop_lock = threading.RLock()
 
-        # Request management
+        # Request management. The queue holds the intended start time of every outstanding request.
+        self.schedule = None
         self.set_requests_per_second(1)
         self.production_speedup_timeout = 60
         self.production_speedup_increment = 1
-        self.request_semaphore = threading.Semaphore(0)
+        self.request_queue = queue.Queue()
+
+        # Closed-loop mode. active_users is None in open-loop mode.
+        self.active_users = None
+
+        # While paused, open-loop producers release no requests
+        self.paused = False
+        self.think_time = 0
+        self.users_in_threads = True
+        self.user_threads = {}
+        self.users_lock = threading.Lock()
 
     def connection(self, description="<unknown>", fatal=False):
         """Create a new database connection (use in with: statement)"""
         return DatabaseConnection(self, description, fatal)
 
-    def record_results(self, values):
-        """Add new results to the results buffer."""
-        flush_results = False
-        try:
-            self.results_lock.acquire()
-            self.results.append(values)
-            self.request_nr += 1
-            if len(self.results) >= self.results_buffer:
-                flush_results = True
-                results_copy = list(self.results)
-                self.results = []
-        finally:
-            self.results_lock.release()
-        if flush_results:
-            self.commit_results(results_copy)
+    def set_result_value(self, name, value):
+        """Set the value of an extra result column for the request currently executed by this thread."""
+        self.local.values[name] = value
+
+    def record_results(self, values, extra=None):
+        """Add new results to the results buffer.
+        Extra column values are taken from set_result_value, unless passed explicitly (used by the asyncio engine)."""
+        if self.extra_columns:
+            if extra is None:
+                extra = getattr(self.local, 'values', {})
+            values = tuple(values) + tuple([ extra.get(name) for name, _ in self.extra_columns ])
+        self.results.append(values)
+
+    def record_error(self, exception):
+        """Classify an exception raised by a request and return its error code, to be stored in the error column."""
+        return self.errors.record(exception)
+
+    def result_summary(self, values):
+        """Return start, latency and error of a result row. By default the columns between start and error
+        (the last column recorded by execute_request) add up to the latency."""
+        n = len(values) - len(self.extra_columns)
+        return values[0], sum(values[1:n-1]), values[n-1]
+
+    def completed_requests(self):
+        with self.results_lock:
+            return self.request_nr + len(self.results)
 
     def flush_results(self):
-        """Write all values currently in the results-buffer into the database."""
-        try:
-            self.results_lock.acquire()
-            results_copy = list(self.results)
-            self.results = []
-        finally:
-            self.results_lock.release()
-        self.commit_results(results_copy)
+        """Write all values currently in the results-buffer into the database and stop the writer thread."""
+        self.writer.stop()
+        if self.result_sink is not None:
+            self.result_sink.close()
+        with self.connection(description="writing error codes") as c:
+            self.errors.write(c)
 
-    def commit_results(self, values):
-        """Write the given values into the database."""
-        if len(values) > 0:
-            with self.connection(description="updating values") as c:
-                log("Committing %i results" % len(values))
-                c.executemany(self.commit_query, values)
+    def sample_results(self, values):
+        """Return the results to store, with their weight appended when downsampling. Only called from the writer thread."""
+        if self.sample_rate < 1:
+            weight = 1.0 / self.sample_rate
+            sampled = []
+            for row in values:
+                _, latency, error = self.result_summary(row)
+                if error is not None or (self.slow_threshold > 0 and latency >= self.slow_threshold):
+                    sampled.append(tuple(row) + (1.0,))
+                elif random.random() < self.sample_rate:
+                    sampled.append(tuple(row) + (weight,))
+            values = sampled
+        self.results_stored += len(values)
+        return values
+
+    def commit_results(self, connection, values):
+        """Write the given values into the database (or the result sink). Only called from the writer thread."""
+        log("Committing %i results" % len(values))
+        if self.result_sink is not None:
+            self.result_sink.append(values)
+        else:
+            connection.executemany(self.commit_query, values)
 
     def execution_worker(self):
         while self.workers_running:
-            self.request_semaphore.acquire()
-            if self.workers_running:
+            intended = self.request_queue.get()
+            if self.workers_running and intended is not None:
+                self.local.values = { "lag": time.time() - intended }
                 self.execute_request()
                 self.last_request_end = time.time()
 
@@ -261,26 +1215,90 @@ class LoadGenerator(object):
         thread = threading.Thread(target = self.execution_worker)
         self.threads.append(thread)
 
+    def set_users(self, users):
+        """Run in closed-loop mode with the given number of virtual users. Surplus users stop after their current request."""
+        self.active_users = users
+        if self.users_in_threads:
+            for user in range(users):
+                if user not in self.user_threads or not self.user_threads[user].is_alive():
+                    thread = threading.Thread(target = self.user_worker, args = (user,))
+                    thread.daemon = True
+                    self.user_threads[user] = thread
+                    thread.start()
+
+    def user_worker(self, user):
+        while self.workers_running and user < self.active_users:
+            with self.users_lock:
+                self.requests_released += 1
+            self.local.values = {}
+            self.execute_request()
+            self.last_request_end = time.time()
+            if self.think_time > 0 and self.workers_running:
+                time.sleep(self.think_time)
+
     def create_production_worker(self):
+        if self.schedule is not None:
+            return self.create_scheduled_production_worker()
         def produce():
             while self.workers_running:
                 time.sleep(self.producer_timeout)
-                if self.workers_running:
+                if self.workers_running and not self.paused:
                     self.increment_requests()
         thread = threading.Thread(target = produce)
         self.threads.append(thread)
 
+    def create_scheduled_production_worker(self):
+        """Release every request at its intended start time, regardless of how many requests are still outstanding."""
+        def produce():
+            self.schedule.start(time.time())
+            while self.workers_running:
+                if self.paused:
+                    # Continue the schedule from the end of the pause
+                    while self.paused and self.workers_running:
+                        time.sleep(WRITER_POLL_INTERVAL)
+                    self.schedule.start(time.time())
+                    continue
+                intended = self.schedule.next_time()
+                if intended is None:
+                    # Wait until the workers took all requests, then stop like the timeout does
+                    while self.workers_running and not self.request_queue.empty():
+                        time.sleep(WRITER_POLL_INTERVAL)
+                    self.schedule_finished()
+                    break
+                sleep_until(intended)
+                if self.workers_running:
+                    self.request_queue.put(intended)
+                    self.requests_released += 1
+        thread = threading.Thread(target = produce)
+        self.threads.append(thread)
+
+    def schedule_finished(self):
+        """Called when the schedule has no more requests. Stops the run."""
+        if self.workers_running:
+            log("Schedule finished, stopping")
+            self.stop_running()
+
     def increment_requests(self):
         # Add X outstanding jobs to the "queue"
+        now = time.time()
         for _ in range(self.producer_increment):
-            self.request_semaphore.release()
+            self.request_queue.put(now)
+        self.requests_released += self.producer_increment
+
+    def set_schedule(self, schedule):
+        """Use an open-loop Schedule instead of releasing requests in bursts."""
+        self.schedule = schedule
 
     def start_production_speedup_worker(self):
         """This thread will be started as a daemon immediately due to the long sleep time"""
         def speedup_production():
             while self.workers_running:
                 time.sleep(self.production_speedup_timeout)
-                if self.workers_running:
+                if self.workers_running and self.active_users is not None:
+                    users = self.active_users + self.production_speedup_increment
+                    log("Setting users to %i" % users)
+                    self.set_users(users)
+                elif self.workers_running:
                     reqs = self.requests_per_second()
                     reqs += self.production_speedup_increment
                     log("Setting requests_per_second to %i" % reqs)
@@ -290,25 +1308,40 @@ class LoadGenerator(object):
         thread.start()
 
     def set_requests_per_second(self, requests_per_second):
+        if self.schedule is not None:
+            self.schedule.set_requests_per_second(requests_per_second)
         self.producer_increment = int(float(BASE_PRODUCER_TIMEOUT) * float(requests_per_second))
         if self.producer_increment <= 0: self.producer_increment = 1
         self.producer_timeout = float(self.producer_increment) / float(requests_per_second) # Adjust value to fix int-rounding above
 
     def requests_per_second(self):
+        if self.schedule is not None:
+            return self.schedule.requests_per_second()
         return (1/self.producer_timeout) * self.producer_increment
 
     def finish_workers(self):
         for i, thread in enumerate(self.threads):
             # log("Waiting for %i threads..." % (len(self.threads) - i))
             thread.join()
+        for thread in list(self.user_threads.values()):
+            thread.join()
 
     def stop_running(self):
+        """Stop the run. Can be called by any thread, more than once."""
+        with self.stop_lock:
+            if self.stopped.is_set():
+                return
+            self.stopped.set()
         log("Stopping workers...")
         self.workers_running = False
         for _ in range(len(self.threads)):
             # Wake up all threads that might be waiting
-            self.request_semaphore.release()
+            self.request_queue.put(None)
+
+    def cleanup(self):
+        """Hook called after all requests finished and results were written, e.g. to delete created resources."""
+        pass
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(main(sys.argv[1:]))
 
@@ -0,0 +1,227 @@
+
+# asyncio execution engine. Requires Python 3 and aiohttp, selected with loadgen.py --engine asyncio.
+
+import asyncio, json, time, threading
+import aiohttp
+import loadgen
+import openstack_api as api
+from loadgen import log
+from loadgen_custom_api import OpenstackRequestGenerator, WorkloadMixGenerator
+
+# Seconds between checks for added virtual users in closed-loop mode.
+USER_CHECK_INTERVAL = 0.1
+
+class AsyncEngine(object):
+    """Dispatches the requests of a LoadGenerator from one event loop, instead of a pool of blocking worker threads.
+    The generator must implement the coroutine execute_request_async(extra) and can implement
+    start_async() and stop_async() to set up and tear down resources living in the event loop."""
+
+    def __init__(self, generator, concurrency=loadgen.ASYNC_CONCURRENCY):
+        self.generator = generator
+        self.concurrency = concurrency
+        # Virtual users of the closed-loop mode are coroutines
+        generator.users_in_threads = False
+
+    def create_thread(self):
+        thread = threading.Thread(target = self.run)
+        self.generator.threads.append(thread)
+        return thread
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.produce())
+        finally:
+            loop.close()
+
+    async def produce(self):
+        g = self.generator
+        if hasattr(g, 'start_async'):
+            await g.start_async()
+        if g.active_users is not None:
+            await self.run_users()
+        else:
+            await self.run_schedule()
+        if hasattr(g, 'stop_async'):
+            await g.stop_async()
+
+    async def run_schedule(self):
+        g = self.generator
+        limit = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        g.schedule.start(time.time())
+        while g.workers_running:
+            if g.paused:
+                while g.paused and g.workers_running:
+                    await asyncio.sleep(USER_CHECK_INTERVAL)
+                g.schedule.start(time.time())
+                continue
+            intended = g.schedule.next_time()
+            if intended is None:
+                g.schedule_finished()
+                break
+            delay = intended - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Blocks when the concurrency limit is reached, the delay shows up as lag of the next requests.
+            await limit.acquire()
+            if not g.workers_running:
+                limit.release()
+                break
+            task = asyncio.ensure_future(self.request(intended, limit))
+            g.requests_released += 1
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            log("Waiting for %i requests in flight..." % len(pending))
+            await asyncio.wait(pending)
+
+    async def run_users(self):
+        g = self.generator
+        users = {}
+        while g.workers_running:
+            for user in range(g.active_users):
+                if user not in users or users[user].done():
+                    users[user] = asyncio.ensure_future(self.user(user))
+            await asyncio.sleep(USER_CHECK_INTERVAL)
+        pending = [ u for u in users.values() if not u.done() ]
+        if pending:
+            log("Waiting for %i users..." % len(pending))
+            await asyncio.wait(pending)
+
+    async def user(self, user):
+        g = self.generator
+        while g.workers_running and user < g.active_users:
+            g.requests_released += 1
+            await g.execute_request_async({})
+            g.last_request_end = time.time()
+            if g.think_time > 0 and g.workers_running:
+                await asyncio.sleep(g.think_time)
+
+    async def request(self, intended, limit):
+        try:
+            await self.generator.execute_request_async({ "lag": time.time() - intended })
+            self.generator.last_request_end = time.time()
+        finally:
+            limit.release()
+
+class AsyncOpenstackApi(object):
+    """Non-blocking counterpart of an openstack_api.OpenstackApi, using its endpoint, session and timeout.
+    Connections are reused like in the HttpPool of the api, but the pool size is unlimited by default,
+    as the engine already bounds the number of requests in flight. Several APIs can share the connections
+    of one aiohttp session, passed as http."""
+
+    def __init__(self, sync_api, pool_size=0, http=None):
+        self.api = sync_api
+        self.owns_http = http is None
+        if http is None:
+            timeout = aiohttp.ClientTimeout(total=sync_api.timeout) if sync_api.timeout else None
+            connector = aiohttp.TCPConnector(limit=pool_size, force_close=not sync_api.http.reuse_connections)
+            http = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.http = http
+
+    async def close(self):
+        if self.owns_http:
+            await self.http.close()
+
+    async def basic_get(self, url, params, headers, decode=True):
+        async with self.http.get(url, params=params, headers=headers) as r:
+            r.raise_for_status()
+            if not decode:
+                await r.read()
+                return None
+            return await r.json(content_type=None)
+
+    async def add_token(self, headers):
+        pool = getattr(self.api.session, 'token_pool', None)
+        if pool is not None and pool.hit_ratio < 1:
+            # Token lookups might authenticate synchronously
+            await asyncio.get_event_loop().run_in_executor(None, self.api.add_token, headers)
+        else:
+            self.api.add_token(headers)
+
+    async def check_endpoint(self):
+        if not getattr(self.api, 'endpoint_checked', True):
+            await asyncio.get_event_loop().run_in_executor(None, self.api.check_endpoint_once)
+
+    async def get(self, path, params={}, decode=True):
+        await self.check_endpoint()
+        assert self.api.endpoint, "endpoint attribute is required."
+        headers = {}
+        await self.add_token(headers)
+        return await self.basic_get(str(self.api.endpoint) + path, params, headers, decode)
+
+    async def post(self, path, data={}):
+        await self.check_endpoint()
+        assert self.api.endpoint, "endpoint attribute is required."
+        headers = { "Content-Type": "application/json" }
+        await self.add_token(headers)
+        async with self.http.post(str(self.api.endpoint) + path, data=json.dumps(data), headers=headers) as r:
+            r.raise_for_status()
+            return await r.json(content_type=None)
+
+    async def list(self, path, key=None, field="name", mode=None):
+        # The fields response mode decodes the complete body, there is no streaming parser for aiohttp
+        mode = mode or self.api.response_mode
+        if mode == api.RESPONSE_NONE:
+            return await self.get(path, decode=False)
+        return api.collection_field(await self.get(path), key, field)
+
+    async def call(self, operation, mode=None):
+        """Execute an API method implemented with openstack_api.list_operation."""
+        if not hasattr(operation, 'operation'):
+            raise Exception("API method %s cannot be executed asynchronously." % operation.__name__)
+        path, key, field = operation.operation
+        return await self.list(path, key, field, mode)
+
+class AsyncOpenstackRequestGenerator(OpenstackRequestGenerator):
+    """OpenstackRequestGenerator that also supports the asyncio engine."""
+
+    async def start_async(self):
+        self.async_api = AsyncOpenstackApi(self.api)
+
+    async def stop_async(self):
+        await self.async_api.close()
+
+    async def execute_request_async(self, extra):
+        request_time = 0
+        error = None
+        start = time.time()
+        try:
+            await self.execute_client_request_async(self.async_api)
+            request_time = time.time() - start
+        except Exception as e:
+            error = self.record_error(e)
+        finally:
+            self.record_results((start, request_time, error), extra)
+
+    async def execute_client_request_async(self, async_api):
+        return await async_api.call(self.api.example)
+
+class AsyncWorkloadMixGenerator(WorkloadMixGenerator):
+    """WorkloadMixGenerator that also supports the asyncio engine. All services share one aiohttp session."""
+
+    async def start_async(self):
+        self.async_apis = {}
+        http = None
+        for service, sync_api in self.apis.items():
+            self.async_apis[service] = AsyncOpenstackApi(sync_api, http=http)
+            http = self.async_apis[service].http
+
+    async def stop_async(self):
+        for async_api in self.async_apis.values():
+            await async_api.close()
+
+    async def execute_request_async(self, extra):
+        name, service, method, mode = self.choose_operation()
+        extra = dict(extra, operation=name)
+        request_time = 0
+        error = None
+        start = time.time()
+        try:
+            await self.async_apis[service].call(method, mode)
+            request_time = time.time() - start
+        except Exception as e:
+            error = self.record_error(e)
+        finally:
+            self.record_results((start, request_time, error), extra)
@@ -1,48 +1,373 @@
 
-import time
+import time, random, bisect, collections, threading, uuid
 import loadgen
 from loadgen import log
 import openstack_api as api
 
-def check_args(args):
+def check_args(args, required=[ 'service' ], optional={}):
     from loadgen import check_params
-    check_params(args,
-        [ 'service', 'host', 'user', 'password', 'tenant' ],
-        { 'fix_host': (str, ""), 'http_timeout': (float, 5) })
+    parameters = { 'fix_host': (str, ""), 'identity_port': (int, 0), 'http_timeout': (float, 5),
+        'reuse_connections': (int, 1), 'pool_size': (int, loadgen.NUM_WORKERS),
+        'token_pool': (int, 1), 'token_hit_ratio': (float, 1.0),
+        'version_cache': (str, api.DEFAULT_VERSION_CACHE), 'version_cache_ttl': (float, api.VERSION_CACHE_TTL),
+        'phase_timing': (int, 0), 'response_mode': (str, api.RESPONSE_FULL) }
+    parameters.update(optional)
+    check_params(args, required + [ 'host', 'user', 'password', 'tenant' ], parameters)
+    check_response_mode(args.response_mode)
+
+def check_response_mode(mode):
+    if mode not in api.RESPONSE_MODES:
+        raise Exception("Illegal response mode %s, expected one of %s" % (mode, ", ".join(api.RESPONSE_MODES)))
+    if mode == api.RESPONSE_FIELDS and api.ijson is None:
+        # Without ijson the complete body would be decoded, measuring the full mode
+        raise Exception("Response mode %s requires the ijson module" % mode)
+
+# Maximum number of resources deleted by one cleanup thread at a time, and default number of cleanup threads.
+CLEANUP_BATCH = 100
+CLEANUP_THREADS = 20
+
+# Extra columns recorded with the phase_timing parameter: seconds spent in every phase of the HTTP requests
+# of one operation (see openstack_api.PHASES), and the number of response bytes.
+PHASE_COLUMNS = tuple([ ("%s_time" % phase, "real") for phase in api.PHASES ]) + (("response_bytes", "integer"),)
 
 class OpenstackRequestGenerator(loadgen.LoadGenerator):
     def __init__(self, args):
-        check_args(args)
+        self.check_args(args)
         self.args = args
-        table = loadgen.safe_tablename(args.service)
-        self.create_query = "create table %s (start integer, request_time integer, error text);" % table
+        if args.phase_timing:
+            self.result_columns = tuple(self.result_columns) + PHASE_COLUMNS
+        table = loadgen.safe_tablename(self.table_name())
+        self.create_query = "create table %s (start integer, request_time integer, error integer);" % table
         self.commit_query = "insert into %s values (?, ?, ?);" % table
         super(OpenstackRequestGenerator, self).__init__(args)
         log("Creating session...")
-        self.session, self.api = self.create_session()
+        self.session = self.create_session()
+        self.create_apis()
+
+    def check_args(self, args):
+        check_args(args)
+
+    def table_name(self):
+        return self.args.service
+
+    def create_apis(self):
+        self.api = self.get_api(self.args.service)
         self.auth_url = self.api.endpoint
 
     def create_session(self):
-        s = api.KeystoneSession(identity_host=self.args.host)
+        if self.args.reuse_connections:
+            log("Reusing up to %i connections per host" % self.args.pool_size)
+        else:
+            log("Opening a new connection for every request")
+        http = api.HttpPool(self.args.pool_size, bool(self.args.reuse_connections), bool(self.args.phase_timing))
+        s = api.KeystoneSession(identity_host=self.args.host, identity_port=self.args.identity_port or None, http=http,
+            version_cache=self.args.version_cache, version_cache_ttl=self.args.version_cache_ttl)
         overwrite_host = self.args.fix_host if self.args.fix_host else None
         s.authenticate(self.args.tenant, self.args.user, self.args.password, overwrite_host=overwrite_host)
-        a = s.get_api(self.args.service)
+        if self.args.token_pool > 0:
+            log("Using a pool of %i tokens, %.0f%% of lookups re-authenticate" % (self.args.token_pool, (1 - self.args.token_hit_ratio) * 100))
+            s.use_token_pool(self.args.token_pool, self.args.token_hit_ratio)
+        return s
+
+    def get_api(self, service):
+        a = self.session.get_api(service)
         a.timeout = self.args.http_timeout
-        return s, a
+        a.response_mode = self.args.response_mode
+        return a
 
     def execute_request(self):
         request_time = 0
         error = None
+        if self.args.phase_timing:
+            api.phase_timer.reset()
         try:
             start = time.time()
             self.execute_client_request(self.api)
             request_time = time.time() - start
         except Exception as e:
-            error  = "Exception: %s" % e
-            log(error)
+            error = self.record_error(e)
         finally:
+            if self.args.phase_timing:
+                self.record_phases()
             self.record_results((start, request_time, error))
 
+    def record_phases(self):
+        for phase in api.PHASES:
+            self.set_result_value("%s_time" % phase, api.phase_timer.phases[phase])
+        self.set_result_value("response_bytes", api.phase_timer.response_bytes)
+
     def execute_client_request(self, api):
         return api.example()
 
+    def cleanup(self):
+        pool = self.session.token_pool
+        if pool is not None and pool.measured_hit_ratio() is not None:
+            log("Token pool: %.1f%% of %i lookups served from the pool (target %.1f%%)" %
+                (pool.measured_hit_ratio() * 100, pool.hits + pool.misses, pool.hit_ratio * 100))
+
+class PaginatedListGenerator(OpenstackRequestGenerator):
+    """Lists a collection page by page with one request per page, e.g. -p service=compute page_size=50.
+    Every request continues one of the unfinished walks through the collection, or starts a new walk if all of them
+    are in progress. Walks end after the last page or after max_pages pages. operation selects a list operation
+    of the service API, by default its example. Page number and number of elements are recorded in the page and
+    items columns of the table <service>pages."""
+
+    result_columns = (("page", "integer"), ("items", "integer"))
+
+    def check_args(self, args):
+        check_args(args, optional={ 'page_size': (int, 100), 'max_pages': (int, 0), 'operation': (str, "") })
+        if args.page_size < 1:
+            raise Exception("The page_size parameter must be positive.")
+
+    def table_name(self):
+        return self.args.service + "pages"
+
+    def create_apis(self):
+        super(PaginatedListGenerator, self).create_apis()
+        method = getattr(self.api, self.args.operation, None) if self.args.operation else self.api.example
+        if not hasattr(method, 'operation'):
+            raise Exception("Operation %s of service %s does not list a collection" % (self.args.operation or "example", self.args.service))
+        self.path, self.key, _ = method.operation
+        # (page number, marker) of the next page of every unfinished walk
+        self.walks = collections.deque()
+
+    def execute_client_request(self, api):
+        try:
+            page, marker = self.walks.popleft()
+        except IndexError:
+            page, marker = 0, None
+        self.set_result_value("page", page)
+        try:
+            elements, next_marker = api.page(self.path, self.key, self.args.page_size, marker)
+        except:
+            # Retry the page in a later request
+            self.walks.append((page, marker))
+            raise
+        self.set_result_value("items", len(elements))
+        if next_marker is not None and page + 1 != self.args.max_pages:
+            self.walks.append((page + 1, next_marker))
+        return elements
+
+class ResourceRegistry(object):
+    """Thread-safe set of the ids of live resources. take() removes a random resource,
+    so no other thread uses it until it is added again."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, id):
+        with self.lock:
+            self.ids.append(id)
+
+    def take(self):
+        """Remove and return a random id, or None if there are no resources."""
+        with self.lock:
+            if not self.ids:
+                return None
+            i = random.randrange(len(self.ids))
+            self.ids[i], self.ids[-1] = self.ids[-1], self.ids[i]
+            return self.ids.pop()
+
+    def drain(self):
+        """Remove and return all ids."""
+        with self.lock:
+            ids, self.ids = self.ids, []
+        return ids
+
+class CrudGenerator(OpenstackRequestGenerator):
+    """Creates, reads, updates and deletes resources of one type, e.g. -p service=network resource=network.
+    Operations are chosen randomly, weighted by the create, read, update and delete parameters. Reads, updates and
+    deletes target live resources created by this generator: while there are none a resource is created instead,
+    and while max_resources exist one is deleted instead. Resources left after the run are deleted by cleanup_threads
+    threads in parallel, unless cleanup=0. The operation of every request is recorded in the operation column."""
+
+    result_columns = (("operation", "text"),)
+    operation_names = [ "create", "read", "update", "delete" ]
+
+    def check_args(self, args):
+        check_args(args, optional={ 'resource': (str, ""), 'create': (float, 1), 'read': (float, 1),
+            'update': (float, 1), 'delete': (float, 1), 'max_resources': (int, 0), 'name_prefix': (str, "loadgen"),
+            'cleanup': (int, 1), 'cleanup_threads': (int, CLEANUP_THREADS) })
+        weights = [ getattr(args, name) for name in self.operation_names ]
+        if min(weights) < 0 or sum(weights) <= 0:
+            raise Exception("The weights of the operations %s must not be negative, and not all zero." % ", ".join(self.operation_names))
+
+    def table_name(self):
+        return self.args.service + "crud"
+
+    def create_apis(self):
+        super(CrudGenerator, self).create_apis()
+        resources = self.api.resources
+        self.resource = self.args.resource or (sorted(resources)[0] if resources else None)
+        if self.resource not in resources:
+            services = sorted([ "%s (%s)" % (t, ", ".join(sorted(klass.resources)))
+                for t, klass in api.KeystoneSession.api_class_index().items() if klass.resources ])
+            raise Exception("Resource type %s not supported by service %s. Supported: %s" % (self.resource, self.args.service, ", ".join(services)))
+        log("Creating, reading, updating and deleting %ss" % self.resource)
+        self.registry = ResourceRegistry()
+        self.cumulative_weights = []
+        total = 0
+        for name in self.operation_names:
+            total += getattr(self.args, name)
+            self.cumulative_weights.append(total)
+
+    def new_name(self):
+        return "%s-%s" % (self.args.name_prefix, uuid.uuid4().hex[:12])
+
+    def choose_operation(self):
+        index = bisect.bisect_right(self.cumulative_weights, random.random() * self.cumulative_weights[-1])
+        operation = self.operation_names[min(index, len(self.operation_names) - 1)]
+        if operation == "create" and self.args.max_resources and len(self.registry) >= self.args.max_resources:
+            return "delete"
+        return operation
+
+    def execute_client_request(self, api):
+        operation = self.choose_operation()
+        id = self.registry.take() if operation != "create" else None
+        if id is None:
+            operation = "create"
+        self.set_result_value("operation", operation)
+        if operation == "create":
+            self.registry.add(api.create(self.resource, self.new_name())["id"])
+            return
+        try:
+            if operation == "read":
+                api.show(self.resource, id)
+            elif operation == "update":
+                api.update(self.resource, id, name=self.new_name())
+            else:
+                api.destroy(self.resource, id)
+                id = None
+        finally:
+            # Failed deletes are retried later or in the cleanup
+            if id is not None:
+                self.registry.add(id)
+
+    def cleanup(self):
+        super(CrudGenerator, self).cleanup()
+        ids = self.registry.drain()
+        if not ids:
+            return
+        if not self.args.cleanup:
+            log("Leaving %i %ss" % (len(ids), self.resource))
+            return
+        threads = max(1, min(self.args.cleanup_threads, len(ids)))
+        size = max(1, min(CLEANUP_BATCH, len(ids) // threads))
+        batches = collections.deque([ ids[i:i + size] for i in range(0, len(ids), size) ])
+        failed = []
+        def delete_batches():
+            while True:
+                try:
+                    batch = batches.popleft()
+                except IndexError:
+                    return
+                for id in batch:
+                    try:
+                        self.api.destroy(self.resource, id)
+                    except Exception as e:
+                        failed.append((id, e))
+        log("Deleting %i %ss with %i threads..." % (len(ids), self.resource, threads))
+        start = time.time()
+        workers = [ threading.Thread(target=delete_batches) for _ in range(threads) ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        log("Deleted %i %ss in %.2f seconds" % (len(ids) - len(failed), self.resource, time.time() - start))
+        if failed:
+            log("Failed to delete %i %ss, e.g. %s: %s. Ids: %s" % (len(failed), self.resource, failed[0][0], failed[0][1],
+                " ".join([ str(id) for id, _ in failed ])))
+
+def parse_mix(text):
+    """Parse a workload mix: entries <service>.<operation>[:<weight>[:<response mode>]], separated by commas or lines.
+    Lines starting with # are ignored. Returns a list of (service, operation, weight, mode), mode is None if not given."""
+    mix = []
+    for line in text.splitlines():
+        if line.strip().startswith("#"):
+            continue
+        for entry in line.split(","):
+            entry = entry.strip()
+            if not entry:
+                continue
+            name, _, weight = entry.partition(":")
+            weight, _, mode = weight.partition(":")
+            service, _, operation = name.rpartition(".")
+            if not service or not operation:
+                raise Exception("Illegal workload mix entry %s, expected <service>.<operation>[:<weight>[:<response mode>]]" % entry)
+            if mode:
+                check_response_mode(mode)
+            mix.append((service, operation, float(weight) if weight else 1.0, mode or None))
+    if not mix:
+        raise Exception("Empty workload mix.")
+    return mix
+
+def required_parameters(method):
+    """Names of the parameters of a (bound) method without default value."""
+    import inspect
+    if not hasattr(inspect, 'signature'):
+        spec = inspect.getargspec(method)
+        return spec.args[1:len(spec.args) - len(spec.defaults or ())]
+    return [ p.name for p in inspect.signature(method).parameters.values()
+        if p.default is p.empty and p.kind not in (p.VAR_POSITIONAL, p.VAR_KEYWORD) ]
+
+class WorkloadMixGenerator(OpenstackRequestGenerator):
+    """Executes a weighted mix of API operations of several services, e.g. -p mix=compute.servers:60,image.images:20,network.networks:20:none
+    or a file with one entry per line given as mix_file. All services share the session and its connections.
+    Only list operations without required arguments can be mixed. Entries can choose their own response mode,
+    the others use the response_mode parameter.
+    The operation of every request is recorded in the operation column."""
+
+    result_columns = (("operation", "text"),)
+
+    def check_args(self, args):
+        check_args(args, [], { 'mix': (str, ""), 'mix_file': (str, ""), 'table': (str, "mix") })
+        if bool(args.mix) == bool(args.mix_file):
+            raise Exception("Exactly one of the parameters mix and mix_file is required.")
+
+    def table_name(self):
+        return self.args.table
+
+    def create_apis(self):
+        if self.args.mix_file:
+            with open(self.args.mix_file) as f:
+                mix = parse_mix(f.read())
+        else:
+            mix = parse_mix(self.args.mix)
+        self.apis = {}
+        self.operations = []
+        self.cumulative_weights = []
+        total = 0
+        for service, operation, weight, mode in mix:
+            if service not in self.apis:
+                self.apis[service] = self.get_api(service)
+            method = getattr(self.apis[service], operation, None)
+            if operation.startswith("_") or not callable(method):
+                raise Exception("No operation %s in the API of service %s" % (operation, service))
+            if not hasattr(method, 'operation'):
+                raise Exception("Operation %s of service %s does not list a collection" % (operation, service))
+            required = required_parameters(method)
+            if required:
+                raise Exception("Operation %s of service %s requires the arguments %s" % (operation, service, ", ".join(required)))
+            total += weight
+            self.operations.append(("%s.%s" % (service, operation), service, method, mode))
+            self.cumulative_weights.append(total)
+        log("Workload mix: %s" % ", ".join([ "%s %.1f%%%s" % (name, weight * 100 / total, " (%s)" % mode if mode else "")
+            for (name, _, _, mode), (_, _, weight, _) in zip(self.operations, mix) ]))
+        self.api = None
+        self.auth_url = self.session.api.endpoint
+
+    def choose_operation(self):
+        """Return (name, service, method, mode) of a random operation, according to the weights."""
+        index = bisect.bisect_right(self.cumulative_weights, random.random() * self.cumulative_weights[-1])
+        return self.operations[min(index, len(self.operations) - 1)]
+
+    def execute_client_request(self, api):
+        name, _, method, mode = self.choose_operation()
+        self.set_result_value("operation", name)
+        if mode is not None:
+            return method(mode)
+        return method()
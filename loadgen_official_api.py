@@ -4,7 +4,6 @@ import loadgen
 from loadgen import log
 
 import keystoneclient, novaclient
-from keystoneclient.openstack.common.apiclient.exceptions import AuthorizationFailure
 
 # Pattern for keystone auth_url. The %s will be replaced with the configured host.
 AUTH_URL_PATTERN = 'http://%s:35357/v2.0'
@@ -72,7 +71,7 @@ class AuthenticatingLoadGenerator(loadgen.LoadGenerator):
 class FullSessionGenerator(AuthenticatingLoadGenerator):
     """This generator creates a full session with each request, including complete authentication etc."""
     def __init__(self, args):
-        self.create_query = "create table %s (start integer, authentication_time integer, request_time integer, error text);" % self.table_name()
+        self.create_query = "create table %s (start integer, authentication_time integer, request_time integer, error integer);" % self.table_name()
         self.commit_query = "insert into %s values (?, ?, ?, ?);" % self.table_name()
         super(FullSessionGenerator, self).__init__(args)
 
@@ -88,17 +87,15 @@ class FullSessionGenerator(AuthenticatingLoadGenerator):
             self.execute_client_request(client)
             end = time.time()
             requestTime = end - authenticated
-        except AuthorizationFailure as f:
-            error = "AuthorizationFailure: %s" % f
         except Exception as e:
-            error = "Exception: %s" %e
+            error = self.record_error(e)
         finally:
             self.record_results((start, authenticationTime, requestTime, error))
 
 class AuthenticateOnceGenerator(AuthenticatingLoadGenerator):
     """This generator authenticates once and then sends lightweight requests instead of re-authenticating each time."""
     def __init__(self, args):
-        self.create_query = "create table %s (start integer, request_time integer, error text);" % self.table_name()
+        self.create_query = "create table %s (start integer, request_time integer, error integer);" % self.table_name()
         self.commit_query = "insert into %s values (?, ?, ?);" % self.table_name()
         super(AuthenticateOnceGenerator, self).__init__(args)
         log("Creating session...")
@@ -112,9 +109,7 @@ class AuthenticateOnceGenerator(AuthenticatingLoadGenerator):
             self.execute_client_request(self.client)
             request_time = time.time() - start
         except Exception as e:
-            error  = "Exception: %s" % e
-            # TODO remove
-            print(error)
+            error = self.record_error(e)
         finally:
             self.record_results((start, request_time, error))
 
@@ -0,0 +1,480 @@
+#!/usr/bin/env python
+
+# Local stand-in for an OpenStack cloud, used to measure the load generator itself.
+# Serves Keystone v2.0 versions and tokens, and versions and the example() collection of every API class in
+# openstack_api.py. Every service listens on its own port (versions are listed on "/"): identity on the base port,
+# the other services on the following ports in the order of SERVICES. Collections support the limit and marker
+# query parameters, keyed collections link their following page like Nova and Neutron (e.g. servers_links).
+#
+# Every process serves all connections from one asyncio event loop, latencies are timers instead of sleeping
+# threads. One process needs about 150 us of CPU per request and holds the only copy of the collections. Python 2
+# falls back to one thread per connection, which answers only a few hundred requests per second. --processes
+# spreads connections over several processes, but every process keeps its own collections: an element created
+# in one process is unknown to the others. With more than one process, requests creating, showing, updating or
+# deleting elements are therefore answered with 501, only collections can be listed.
+#
+#   python mock_openstack.py --port 15000 --latency exp:0.005 --error_rate 0.01
+#   python loadgen.py -k loadgen_custom_api.OpenstackRequestGenerator \
+#       -p service=compute host=127.0.0.1 identity_port=15000 user=u password=p tenant=t
+
+from __future__ import print_function
+import sys, json, time, random, socket, threading, multiprocessing, argparse, uuid, bisect
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2, served with one thread per connection
+    asyncio = None
+
+try:
+    # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+DEFAULT_PORT = 15000
+TENANT_ID = "mocktenant"
+
+# Seconds until issued tokens expire.
+TOKEN_LIFETIME = 3600
+
+# Maximum number of connections waiting to be accepted on every port.
+LISTEN_BACKLOG = 1024
+
+# Services of the mock cloud: type, version id, path of the versioned endpoint, endpoint path in the catalog,
+# and the collections below the endpoint as path: (key of the collection in the response, field of the elements).
+# Services without version id do not list versions, like their API classes.
+SERVICES = [
+    ("identity", "v2.0", "/v2.0/", "/v2.0/", { "users": ("users", "username") }),
+    ("compute", "v2.0", "/v2/", "/v2/%(tenant)s/", { "servers": ("servers", "name") }),
+    ("image", "v1.1", "/v1/", "/v1/", { "images": ("images", "name") }),
+    ("volume", "v2.0", "/v2/", "/v2/%(tenant)s/", { "volumes": ("volumes", "name") }),
+    ("network", "v2.0", "/v2.0/", "/v2.0/", { "networks": ("networks", "name") }),
+    ("object-store", None, None, "/v1/AUTH_%(tenant)s/", { "": (None, "name") }),
+    ("orchestration", "v1.0", "/v1/", "/v1/%(tenant)s/", { "stacks": (None, "stack_name") }),
+    ("telemetry", None, None, "/v2/", { "alarms": (None, "name") }),
+]
+
+def log(string):
+    print("%s: %s" % (time.strftime("%d.%m.%Y %H:%M:%S"), string))
+    sys.stdout.flush()
+
+def latency_distribution(spec):
+    """Function returning random latencies in seconds, from a specification: <seconds>, const:<seconds>,
+    uniform:<min>:<max>, exp:<mean>, lognormal:<median>:<sigma> or pareto:<minimum>:<alpha>."""
+    parts = spec.split(":")
+    kind, values = (parts[0], [ float(x) for x in parts[1:] ]) if len(parts) > 1 else ("const", [ float(spec) ])
+    if kind == "const" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "exp" and len(values) == 1:
+        return lambda: random.expovariate(1.0 / values[0]) if values[0] > 0 else 0
+    if kind == "lognormal" and len(values) == 2:
+        import math
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    if kind == "pareto" and len(values) == 2:
+        return lambda: values[0] * random.paretovariate(values[1])
+    raise ValueError("Illegal latency distribution: %s" % spec)
+
+class MockCloud(object):
+    """Responses of all mock services. Collection bodies are encoded once, as their content does not change."""
+
+    def __init__(self, options):
+        self.options = options
+        self.public_host = options.public_host or options.host
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        default_latency = latency_distribution(options.latency)
+        overrides = dict([ o.split("=", 1) for o in options.service_latency or [] ])
+        self.services = []
+        for i, (name, version, version_path, endpoint_path, collections) in enumerate(SERVICES):
+            port = options.port + i
+            endpoint_path = endpoint_path % { "tenant": TENANT_ID }
+            latency = latency_distribution(overrides[name]) if name in overrides else default_latency
+            paths = {}
+            for path, (key, field) in collections.items():
+                paths[endpoint_path + path] = self.collection(name, self.url(port, endpoint_path + path), key, field)
+            self.services.append(MockService(self, name, port, version, version_path, endpoint_path, paths, latency))
+
+    def url(self, port, path):
+        return "http://%s:%i%s" % (self.public_host, port, path)
+
+    def collection(self, name, url, key, field):
+        padding = "x" * self.options.item_size
+        items = [ { "id": str(i), field: "%s-%i" % (name, i), "padding": padding } for i in range(self.options.items) ]
+        return MockCollection(url, key, field, items, self.options.page_limit)
+
+    def token(self):
+        expires = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + self.options.token_lifetime))
+        catalog = []
+        for service in self.services:
+            url = service.url(service.endpoint_path)
+            catalog.append({ "type": service.name, "name": service.name,
+                "endpoints": [ { "adminURL": url, "internalURL": url, "publicURL": url } ] })
+        return json.dumps({ "access": {
+            "token": { "id": uuid.uuid4().hex, "expires": expires, "tenant": { "id": TENANT_ID, "name": TENANT_ID } },
+            "serviceCatalog": catalog,
+            "user": { "id": "mockuser", "name": "mockuser", "roles": [] },
+            "metadata": { "is_admin": 0, "roles": [] }
+        }}).encode("utf-8")
+
+    def count(self, error):
+        with self.lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+
+class MockCollection(object):
+    """Elements of one collection, encoded once. Keyed collections support creating, showing, updating and deleting
+    elements. The complete collection is encoded again only after changes, unless page_limit restricts the number
+    of elements per response like osapi_max_limit of Nova."""
+
+    def __init__(self, url, key, field, items, page_limit=0):
+        self.url = url
+        self.key = key
+        self.singular = key[:-1] if key else None
+        self.field = field
+        self.page_limit = page_limit
+        self.lock = threading.Lock()
+        # Ids are increasing integers, ids holds them in order, encoded the element of every id
+        self.ids = []
+        self.encoded = {}
+        self.names = {}
+        for item in items:
+            self.insert(item)
+        self.next_id = len(items)
+        self.full = None
+
+    def insert(self, item):
+        id = int(item["id"])
+        self.ids.append(id)
+        self.encoded[id] = json.dumps(item).encode("utf-8")
+        self.names[item[self.field]] = id
+
+    def position(self, marker):
+        """Position of the element following the element with the given id or name, or None."""
+        id = self.names.get(marker)
+        if id is None:
+            try:
+                id = int(marker)
+            except ValueError:
+                return None
+        if id not in self.encoded:
+            return None
+        return bisect.bisect_right(self.ids, id)
+
+    def body(self, begin, end, next_url):
+        elements = b"[" + b", ".join([ self.encoded[id] for id in self.ids[begin:end] ]) + b"]"
+        if self.key is None:
+            return elements
+        links = b""
+        if next_url is not None:
+            links = (', "%s_links": [{"rel": "next", "href": "%s"}]' % (self.key, next_url)).encode("utf-8")
+        return ('{"%s": ' % self.key).encode("utf-8") + elements + links + b"}"
+
+    def respond(self, query):
+        """Return status and body of the page selected by the query parameters."""
+        with self.lock:
+            if not self.page_limit and "limit" not in query and "marker" not in query:
+                if self.full is None:
+                    self.full = self.body(0, len(self.ids), None)
+                return 200, self.full
+            begin = 0
+            if "marker" in query:
+                begin = self.position(query["marker"][0])
+                if begin is None:
+                    return 400, b'{"error": "Marker not found"}'
+            try:
+                limit = int(query["limit"][0]) if "limit" in query else len(self.ids)
+            except ValueError:
+                return 400, b'{"error": "Illegal limit"}'
+            if self.page_limit:
+                limit = min(limit, self.page_limit)
+            end = min(begin + max(limit, 0), len(self.ids))
+            next_url = None
+            if end < len(self.ids):
+                next_url = "%s?limit=%i&marker=%s" % (self.url, limit, self.ids[end - 1] if end > 0 else "")
+            return 200, self.body(begin, end, next_url)
+
+    def element(self, id):
+        return ('{"%s": ' % self.singular).encode("utf-8") + self.encoded[id] + b"}"
+
+    def change(self, method, id, body):
+        """Return status and body of a request creating (id None), showing, updating or deleting an element."""
+        if self.key is None:
+            return 405, b'{"error": "Method not allowed"}'
+        if method in ("POST", "PUT"):
+            try:
+                attributes = json.loads(body.decode("utf-8"))[self.singular]
+            except (ValueError, KeyError, TypeError):
+                return 400, b'{"error": "Malformed request body"}'
+        with self.lock:
+            if method == "POST" and id is None:
+                item = dict(attributes, id=str(self.next_id))
+                item[self.field] = attributes.get("name")
+                self.next_id += 1
+                self.insert(item)
+                self.full = None
+                return 201, self.element(self.ids[-1])
+            try:
+                id = int(id)
+            except (ValueError, TypeError):
+                id = None
+            if id not in self.encoded:
+                return 404, b'{"error": "Not found"}'
+            if method == "GET":
+                return 200, self.element(id)
+            if method == "PUT":
+                item = json.loads(self.encoded[id].decode("utf-8"))
+                item.update(attributes)
+                if "name" in attributes:
+                    item[self.field] = attributes["name"]
+                self.encoded[id] = json.dumps(item).encode("utf-8")
+                self.full = None
+                return 200, self.element(id)
+            if method == "DELETE":
+                item = json.loads(self.encoded.pop(id).decode("utf-8"))
+                if self.names.get(item[self.field]) == id:
+                    del self.names[item[self.field]]
+                del self.ids[bisect.bisect_left(self.ids, id)]
+                self.full = None
+                return 204, b""
+        return 405, b'{"error": "Method not allowed"}'
+
+class MockService(object):
+    """One service on one port: versions on "/", collections and their elements below the endpoint, tokens for identity."""
+
+    def __init__(self, cloud, name, port, version, version_path, endpoint_path, collections, latency):
+        self.cloud = cloud
+        self.name = name
+        self.port = port
+        self.endpoint_path = endpoint_path
+        self.collections = collections
+        self.latency = latency
+        self.versions = None
+        if version is not None:
+            versions = [ { "id": version, "status": "CURRENT", "links": [ { "rel": "self", "href": self.url(version_path) } ] } ]
+            self.versions = json.dumps({ "versions": { "values": versions } if name == "identity" else versions }).encode("utf-8")
+
+    def url(self, path):
+        return self.cloud.url(self.port, path)
+
+    def respond(self, method, path, headers, query={}, body=b""):
+        """Return status, body and the seconds to wait before sending the response of a request.
+        headers is looked up with lower-case names, query holds the lists of values of the query parameters."""
+        if path == "/" and method == "GET" and self.versions is not None:
+            return 200, self.versions, 0
+        if self.name == "identity" and path == self.endpoint_path + "tokens" and method == "POST":
+            return 200, self.cloud.token(), 0
+        collection, id = path, None
+        if path not in self.collections:
+            collection, _, id = path.rpartition("/")
+        if collection not in self.collections or (id is None and method not in ("GET", "POST")):
+            return 404, b'{"error": "Not found"}', 0
+        if not headers.get("x-auth-token"):
+            return 401, b'{"error": "Authentication required"}', 0
+        if (id is not None or method != "GET") and self.cloud.options.processes > 1:
+            return 501, b'{"error": "Changing collections requires a mock cloud with one process"}', 0
+        delay = self.latency()
+        if self.cloud.options.error_rate > 0 and random.random() < self.cloud.options.error_rate:
+            self.cloud.count(True)
+            return self.cloud.options.error_status, b'{"error": "Injected error"}', delay
+        if id is None and method == "GET":
+            status, body = self.collections[collection].respond(query)
+        else:
+            status, body = self.collections[collection].change(method, id, body)
+        self.cloud.count(status >= 400)
+        return status, body, delay
+
+def http_response(status, body):
+    """Status line, headers and body of a response, to be sent in one write."""
+    head = "HTTP/1.1 %i %s\r\nContent-Type: application/json\r\nContent-Length: %i\r\n\r\n" % (
+        status, BaseHTTPRequestHandler.responses.get(status, ("",))[0], len(body))
+    return head.encode("ascii") + body
+
+class MockProtocol(object):
+    """asyncio protocol of one connection to a service. Requests of a connection are answered in order:
+    while a response waits for the latency of the service, the following requests are not parsed."""
+
+    def __init__(self, service, loop):
+        self.service = service
+        self.loop = loop
+        self.transport = None
+        self.buffer = b""
+        self.waiting = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def eof_received(self):
+        return False
+
+    def data_received(self, data):
+        self.buffer += data
+        self.process()
+
+    def process(self):
+        while not self.waiting and self.transport is not None:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end < 0:
+                return
+            lines = self.buffer[:end].decode("latin-1").split("\r\n")
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            try:
+                method, target, version = lines[0].split(" ")
+                length = int(headers.get("content-length") or 0)
+            except ValueError:
+                self.transport.close()
+                self.transport = None
+                return
+            if len(self.buffer) < end + 4 + length:
+                return
+            body = self.buffer[end + 4:end + 4 + length]
+            self.buffer = self.buffer[end + 4 + length:]
+            path, _, query = target.partition("?")
+            status, body, delay = self.service.respond(method, path, headers, parse_qs(query), body)
+            close = version == "HTTP/1.0" or headers.get("connection", "").lower() == "close"
+            if delay > 0:
+                self.waiting = True
+                self.loop.call_later(delay, self.send_later, http_response(status, body), close)
+            else:
+                self.send(http_response(status, body), close)
+
+    def send(self, response, close):
+        self.transport.write(response)
+        if close:
+            self.transport.close()
+            self.transport = None
+
+    def send_later(self, response, close):
+        self.waiting = False
+        if self.transport is not None:
+            self.send(response, close)
+            self.process()
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        request_body = self.rfile.read(length) if length else b""
+        url = urlparse(self.path)
+        status, body, delay = self.server.service.respond(method, url.path, self.headers, parse_qs(url.query), request_body)
+        if delay > 0:
+            time.sleep(delay)
+        self.wfile.write(http_response(status, body))
+
+    def log_message(self, format, *args):
+        pass
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """Server with one thread per connection, used without asyncio."""
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = LISTEN_BACKLOG
+
+    def __init__(self, address, service, reuse_port=False):
+        HTTPServer.__init__(self, address, MockHandler, bind_and_activate=False)
+        self.service = service
+        if reuse_port:
+            # Several processes accept connections on the same port
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_bind()
+        self.server_activate()
+
+def serve(options, index=0):
+    cloud = MockCloud(options)
+    if asyncio is not None:
+        loop = asyncio.new_event_loop()
+        for service in cloud.services:
+            loop.run_until_complete(loop.create_server(lambda service=service: MockProtocol(service, loop),
+                options.host, service.port, reuse_address=True, reuse_port=options.processes > 1, backlog=LISTEN_BACKLOG))
+        thread = threading.Thread(target=loop.run_forever)
+        thread.daemon = True
+        thread.start()
+    else:
+        for service in cloud.services:
+            server = MockServer((options.host, service.port), service, reuse_port=options.processes > 1)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+    if index == 0:
+        log("Serving %s on %s, ports %i-%i" % (", ".join([ s.name for s in cloud.services ]),
+            options.host, options.port, options.port + len(cloud.services) - 1))
+        if options.processes > 1:
+            log("Every process has its own collections, creating, showing, updating and deleting elements is disabled")
+    last = 0
+    while True:
+        time.sleep(options.report_interval or 3600)
+        if options.report_interval:
+            requests, errors = cloud.requests, cloud.errors
+            log("Process %i: %.1f requests per second, %i injected errors" % (index, float(requests - last) / options.report_interval, errors))
+            last = requests
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Local mock OpenStack cloud for measuring the load generator.')
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on.')
+    parser.add_argument('--public_host', default=None, help='Host name used in the service catalog, by default --host.')
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int, help='Port of the identity service. The other services use the following %i ports.' % (len(SERVICES) - 1))
+    parser.add_argument('--latency', default='0', help='Latency of collection requests in seconds: <seconds>, const:<s>, uniform:<min>:<max>, exp:<mean>, lognormal:<median>:<sigma> or pareto:<min>:<alpha>.')
+    parser.add_argument('--service_latency', nargs='*', help='Latency of single services as <service type>=<distribution>.')
+    parser.add_argument('--error_rate', default=0, type=float, help='Fraction of collection requests answered with --error_status.')
+    parser.add_argument('--error_status', default=500, type=int, help='HTTP status of injected errors.')
+    parser.add_argument('--items', default=10, type=int, help='Number of elements in every collection.')
+    parser.add_argument('--item_size', default=0, type=int, help='Bytes of padding added to every collection element.')
+    parser.add_argument('--page_limit', default=0, type=int, help='Maximum number of elements per response, 0 for no limit.')
+    parser.add_argument('--token_lifetime', default=TOKEN_LIFETIME, type=int, help='Seconds until issued tokens expire.')
+    parser.add_argument('--processes', default=1, type=int, help='Number of server processes sharing the ports (SO_REUSEPORT). Collections can only be listed with more than one process.')
+    parser.add_argument('--report_interval', default=10, type=float, help='Seconds between two lines of request statistics. 0 disables the output.')
+    options = parser.parse_args(argv)
+    try:
+        latency_distribution(options.latency)
+    except ValueError as e:
+        print(e)
+        return 1
+    if options.processes > 1:
+        processes = [ multiprocessing.Process(target=serve, args=(options, i)) for i in range(options.processes) ]
+        for process in processes:
+            process.daemon = True
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            pass
+    else:
+        try:
+            serve(options)
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,15 +1,47 @@
-import requests, json
+import requests, json, functools, threading, time, random, calendar, os, socket
+from requests.packages.urllib3 import connection as urllib3_connection, connectionpool as urllib3_connectionpool
+from functools import reduce
 
 try:
     # Python 2
-    from urlparse import urlparse
+    from urlparse import urlparse, parse_qs
 except:
     # Python 3
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, parse_qs
+
+try:
+    # Optional, parses only the needed fields of collections in the "fields" response mode
+    import ijson
+except ImportError:
+    ijson = None
 
 KEYSTONE_PUBLIC_PORT = 5000
 KEYSTONE_ADMIN_PORT = 35357
 
+# Default number of kept-alive connections per host, one per load generator worker thread.
+DEFAULT_POOL_SIZE = 100
+
+# Seconds before their expiry at which pooled tokens are replaced.
+TOKEN_REFRESH_MARGIN = 300
+
+# Seconds between two checks for expiring pooled tokens.
+TOKEN_CHECK_INTERVAL = 10
+
+# File caching the versions of all endpoints of a cloud, and seconds after which cached versions are fetched again.
+DEFAULT_VERSION_CACHE = "~/.cache/openstack-loadgen/versions.json"
+VERSION_CACHE_TTL = 3600
+
+# Response modes of collection requests: decode the complete JSON body, stream-parse only the needed field
+# of every element (requires ijson, otherwise the body is decoded completely), or read the body without
+# decoding it, so that only status and size are checked.
+RESPONSE_FULL = "full"
+RESPONSE_FIELDS = "fields"
+RESPONSE_NONE = "none"
+RESPONSE_MODES = [ RESPONSE_FULL, RESPONSE_FIELDS, RESPONSE_NONE ]
+
+# Bytes read at once from streamed response bodies.
+READ_CHUNK = 65536
+
 def enable_http_debugging():
     import httplib
     httplib.HTTPConnection.debuglevel = 1
@@ -71,12 +103,264 @@ class Endpoint(object):
     def __repr__(self):
         return self.__str__()
 
+class VersionCache(object):
+    """Versions documents of the endpoints of one cloud, in a JSON file shared by all processes.
+    Entries are grouped by identity endpoint and expire ttl seconds after the first of them was fetched."""
+
+    def __init__(self, path, identity_endpoint, ttl=VERSION_CACHE_TTL):
+        self.path = os.path.expanduser(path)
+        self.identity = identity_endpoint
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def valid_entry(self, data):
+        entry = data.get(self.identity)
+        if entry is None or entry["time"] + self.ttl < time.time():
+            return None
+        return entry
+
+    def get(self, url):
+        entry = self.valid_entry(self.load())
+        return entry["versions"].get(url) if entry is not None else None
+
+    def put(self, url, versions):
+        with self.lock:
+            data = self.load()
+            entry = self.valid_entry(data)
+            if entry is None:
+                entry = data[self.identity] = { "time": time.time(), "versions": {} }
+            entry["versions"][url] = versions
+            try:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                # Replace the file atomically, other processes might read it
+                temporary = "%s.%i.tmp" % (self.path, os.getpid())
+                with open(temporary, "w") as f:
+                    json.dump(data, f)
+                os.rename(temporary, self.path)
+            except (IOError, OSError) as e:
+                print("Warning: Cannot write version cache %s: %s" % (self.path, e))
+
+# Phases of HTTP requests measured by an HttpPool with timing enabled: name resolution, TCP connect and TLS handshake
+# of new connections, time from sending the request to the response headers, reading and JSON-decoding the body.
+PHASES = [ "dns", "connect", "tls", "ttfb", "body", "decode" ]
+
+class PhaseTimer(threading.local):
+    """Per-thread sums of the phase durations (seconds) and response bytes of all requests since the last reset."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.response_bytes = 0
+
+    def add(self, phase, duration):
+        self.phases[phase] += duration
+
+    def setup_time(self):
+        return self.phases["dns"] + self.phases["connect"] + self.phases["tls"]
+
+phase_timer = PhaseTimer()
+
+class TimedConnectionMixin(object):
+    """Measures name resolution and TCP connect of new urllib3 connections."""
+
+    def _new_conn(self):
+        start = time.time()
+        host = self._dns_host
+        try:
+            # Resolve separately, the connection then uses the first address
+            self._dns_host = socket.getaddrinfo(host, self.port, 0, socket.SOCK_STREAM)[0][4][0]
+        except socket.gaierror:
+            # Reported by the connection attempt
+            pass
+        resolved = time.time()
+        phase_timer.add("dns", resolved - start)
+        try:
+            return super(TimedConnectionMixin, self)._new_conn()
+        finally:
+            self._dns_host = host
+            phase_timer.add("connect", time.time() - resolved)
+
+class TimedHTTPConnection(TimedConnectionMixin, urllib3_connection.HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnectionMixin, urllib3_connection.HTTPSConnection):
+
+    def connect(self):
+        start = time.time()
+        setup = phase_timer.setup_time()
+        super(TimedHTTPSConnection, self).connect()
+        phase_timer.add("tls", time.time() - start - (phase_timer.setup_time() - setup))
+
+class TimedHTTPConnectionPool(urllib3_connectionpool.HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(urllib3_connectionpool.HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = { "http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool }
+
+class CountingReader(object):
+    """File-like view of the raw body of a streamed response, counting the bytes read."""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.size = 0
+
+    def read(self, n=READ_CHUNK):
+        data = self.raw.read(n, decode_content=True)
+        self.size += len(data)
+        return data
+
+class HttpPool(object):
+    """HTTP connections of OpenstackApi objects. Reuses kept-alive connections from a thread-safe pool,
+    or opens a fresh connection for every request if reuse_connections is False.
+    With timing, the phases of every request are added to phase_timer."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, reuse_connections=True, timing=False):
+        self.pool_size = pool_size
+        self.reuse_connections = reuse_connections
+        self.timing = timing
+        self.session = None
+        if reuse_connections or timing:
+            self.session = requests.Session()
+            adapter_class = TimedHTTPAdapter if timing else requests.adapters.HTTPAdapter
+            adapter = adapter_class(pool_connections=pool_size, pool_maxsize=pool_size)
+            self.session.mount("http://", adapter)
+            self.session.mount("https://", adapter)
+
+    def request(self, method, url, stream=False, **kwargs):
+        """Send a request. With stream or timing, only the headers are read, the body is read
+        by decode(), decode_fields() or discard()."""
+        if not self.reuse_connections:
+            kwargs["headers"]["Connection"] = "close"
+        stream = stream or self.timing
+        start = time.time()
+        setup = phase_timer.setup_time()
+        if self.session is not None:
+            r = self.session.request(method, url, stream=stream, **kwargs)
+        else:
+            r = requests.request(method, url, stream=stream, **kwargs)
+        if self.timing:
+            phase_timer.add("ttfb", time.time() - start - (phase_timer.setup_time() - setup))
+        if stream and not r.ok:
+            # Release the connection, the body is not read for errors
+            r.content
+        return r
+
+    def decode(self, r):
+        """Read the body of a response and decode it as JSON."""
+        if not self.timing:
+            return r.json()
+        start = time.time()
+        content = r.content
+        read = time.time()
+        data = r.json()
+        phase_timer.add("body", read - start)
+        phase_timer.add("decode", time.time() - read)
+        phase_timer.response_bytes += len(content)
+        return data
+
+    def decode_fields(self, r, key, field):
+        """Stream-parse one field of every element of a collection from the body of a streamed response.
+        key selects the collection inside the response, like in collection_field()."""
+        if ijson is None:
+            return collection_field(self.decode(r), key, field)
+        start = time.time()
+        reader = CountingReader(r.raw)
+        prefix = "item" if key is None else "%s.item" % key
+        values = list(ijson.items(reader, "%s.%s" % (prefix, field)))
+        # Read the rest of the body, so the connection can be reused
+        while reader.read():
+            pass
+        if self.timing:
+            # Reading and parsing are interleaved, their sum is recorded as decode time
+            phase_timer.add("decode", time.time() - start)
+            phase_timer.response_bytes += reader.size
+        return values
+
+    def discard(self, r):
+        """Read the body of a streamed response without decoding it. Returns its size in bytes."""
+        start = time.time()
+        size = 0
+        for chunk in r.iter_content(READ_CHUNK):
+            size += len(chunk)
+        if self.timing:
+            phase_timer.add("body", time.time() - start)
+            phase_timer.response_bytes += size
+        return size
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+
+class Prefetch(threading.Thread):
+    """Calls a function in the background. result() waits for its return value, or raises its exception."""
+
+    def __init__(self, func, *args):
+        super(Prefetch, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def collection_field(data, key, field):
+    """Return one field of every element of a collection. key selects the collection inside the response."""
+    if key is not None:
+        data = data[key]
+    return [ x[field] for x in data ]
+
+def list_operation(path, key=None, field="name"):
+    """Implement an API method as GET of a collection, returning one field of every element.
+    The method takes an optional response mode, see OpenstackApi.list().
+    The (path, key, field) description is kept in the operation attribute, so other engines can issue the same call."""
+    def decorator(func):
+        @functools.wraps(func)
+        def decorated(self, mode=None):
+            return self.list(path, key, field, mode)
+        decorated.operation = (path, key, field)
+        return decorated
+    return decorator
+
 class OpenstackApi(object):
-    def __init__(self, session=None, endpoint=None):
+    # Field of collection elements passed as marker to request the following page
+    marker_field = "id"
+
+    def __init__(self, session=None, endpoint=None, http=None):
         self.session = session
         self.endpoint = endpoint
+        self.http = http if http is not None else HttpPool()
         self.do_authenticate = True
         self.timeout = None
+        self.version_cache = None
+        self.response_mode = RESPONSE_FULL
 
     def set_endpoint(self, new_endpoint):
         self.endpoint = new_endpoint
@@ -96,42 +380,122 @@ class OpenstackApi(object):
     def check_response(self, r):
         r.raise_for_status()
 
-    def basic_get(self, url, params, headers):
+    def basic_get(self, url, params, headers, read=None):
+        """GET url and return the decoded JSON body, or the result of read(response) for a streamed response."""
         kwargs = {
             'params': params,
             'headers': headers
         }
         if self.timeout:
             kwargs['timeout'] = self.timeout
-        r = requests.get(url, **kwargs)
+        r = self.http.request("GET", url, stream=read is not None, **kwargs)
         self.check_response(r)
-        return r.json()
+        if read is not None:
+            return read(r)
+        return self.http.decode(r)
 
-    def get(self, path, params={}):
+    def get(self, path, params={}, read=None):
         assert self.endpoint, "endpoint attribute is required."
         headers = {}
         self.add_token(headers)
-        return self.basic_get(str(self.endpoint) + path, params, headers)
-
-    def post(self, path, data={}):
+        return self.basic_get(str(self.endpoint) + path, params, headers, read)
+
+    def list(self, path, key=None, field="name", mode=None):
+        """One field of every element of a collection. mode (by default the response_mode attribute) is one of
+        RESPONSE_MODES, in mode RESPONSE_NONE the body is not decoded and None is returned."""
+        mode = mode or self.response_mode
+        if mode == RESPONSE_NONE:
+            self.get(path, read=self.http.discard)
+            return None
+        if mode == RESPONSE_FIELDS:
+            return self.get(path, read=lambda r: self.http.decode_fields(r, key, field))
+        return collection_field(self.get(path), key, field)
+
+    def page(self, path, key=None, limit=None, marker=None, params={}):
+        """One page of a collection: at most limit elements (by default as many as the API returns) after the
+        element with the given marker. Returns the list of elements and the marker of the following page,
+        which is None after the last page."""
+        params = dict(params)
+        if limit:
+            params["limit"] = limit
+        if marker is not None:
+            params["marker"] = marker
+        data = self.get(path, params)
+        elements = data[key] if key is not None else data
+        return elements, self.next_marker(data, key, elements, limit)
+
+    def next_marker(self, data, key, elements, limit):
+        # Take the marker from a "next" link if the API returns one (e.g. servers_links of Nova, networks_links
+        # of Neutron or next of Glance v2). Otherwise a full page is followed by the page after its last element.
+        if isinstance(data, dict):
+            hrefs = [ link["href"] for link in data.get("%s_links" % key, []) if link.get("rel") == "next" ]
+            if data.get("next"):
+                hrefs.append(data["next"])
+            for href in hrefs:
+                markers = parse_qs(urlparse(href).query).get("marker")
+                if markers:
+                    return markers[0]
+        if limit and len(elements) >= limit:
+            return elements[-1][self.marker_field]
+        return None
+
+    def pages(self, path, key=None, limit=None, params={}, prefetch=False):
+        """Generator of the pages of a collection, each a list of at most limit elements, see page().
+        With prefetch, the following page is requested in the background while the caller processes the current one.
+        Requests of prefetched pages are not added to the phase_timer of the calling thread."""
+        marker = None
+        pending = None
+        while True:
+            if pending is not None:
+                elements, next_marker = pending.result()
+            else:
+                elements, next_marker = self.page(path, key, limit, marker, params)
+            last = next_marker is None or next_marker == marker
+            pending = Prefetch(self.page, path, key, limit, next_marker, params) if prefetch and not last else None
+            if elements:
+                yield elements
+            if last:
+                return
+            marker = next_marker
+
+    def send(self, method, path, data=None):
+        """Send a request with an optional JSON body. Returns the decoded response, or None for empty responses."""
         assert self.endpoint, "endpoint attribute is required."
-        headers = { "Content-Type": "application/json" }
+        headers = {}
         self.add_token(headers)
         kwargs = {
-            'data': json.dumps(data),
             'headers': headers
         }
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+            kwargs['data'] = json.dumps(data)
         if self.timeout:
             kwargs['timeout'] = self.timeout
-        r = requests.post(str(self.endpoint) + path, **kwargs)
+        r = self.http.request(method, str(self.endpoint) + path, **kwargs)
         self.check_response(r)
-        return r.json()
+        if r.status_code == 204 or r.headers.get("Content-Length") == "0":
+            # Release the connection of streamed responses
+            r.content
+            return None
+        return self.http.decode(r)
+
+    def post(self, path, data={}):
+        return self.send("POST", path, data)
+
+    def put(self, path, data={}):
+        return self.send("PUT", path, data)
+
+    def delete(self, path):
+        return self.send("DELETE", path)
 
     def versions(self, overwrite_host=None):
         """Almost every Openstack API supports listing API versions on the default path"""
         url = Endpoint.change_url_path(self.endpoint, '')
-        versions = self.basic_get(url, {}, {})
-        versions = self.parse_versions(versions)
+        versions = self.version_cache.get(url) if self.version_cache is not None else None
+        if versions is None:
+            versions = self.parse_versions(self.basic_get(url, {}, {}))
+            if self.version_cache is not None:
+                self.version_cache.put(url, versions)
         result = {}
         for version in versions:
             versionid = version["id"]
@@ -151,12 +515,12 @@ class OpenstackApi(object):
         return versions["versions"]
 
 class BasicIdentityApi(OpenstackApi):
-    def __init__(self, host=None, port=None, endpoint=None):
+    def __init__(self, host=None, port=None, endpoint=None, http=None):
         if not endpoint:
             assert host, "Either endpoint or host parameter is required"
             if not port: port = KEYSTONE_PUBLIC_PORT
             endpoint = "http://%s:%i/" % (host, port)
-        super(BasicIdentityApi, self).__init__(None, endpoint)
+        super(BasicIdentityApi, self).__init__(None, endpoint, http)
 
     def parse_versions(self, versions):
         return versions["versions"]["values"]
@@ -183,7 +547,83 @@ class BasicIdentityApi(OpenstackApi):
             services[t] = Endpoint.from_json(endpoints[0])
         return (a["token"], services, a["user"], a["metadata"])
 
+def token_expiry(token):
+    """Expiry of a Keystone v2.0 token as unix timestamp, e.g. from 2015-06-01T12:00:00Z or 2015-06-01T12:00:00.000000Z"""
+    return calendar.timegm(time.strptime(token["expires"][:19], "%Y-%m-%dT%H:%M:%S"))
+
+class TokenPool(object):
+    """Bounded pool of tokens for one set of credentials, shared by all threads using a KeystoneSession.
+    A background thread replaces tokens before they expire. hit_ratio is the fraction of lookups served
+    from the pool, all other lookups authenticate at Keystone and replace the oldest pooled token."""
+
+    def __init__(self, api, credentials, size=1, hit_ratio=1.0, refresh_margin=TOKEN_REFRESH_MARGIN, initial=None):
+        self.api = api
+        self.credentials = credentials
+        self.size = max(1, size)
+        self.hit_ratio = hit_ratio
+        self.refresh_margin = refresh_margin
+        self.lock = threading.Lock()
+        self.tokens = []
+        self.next = 0
+        self.hits = self.misses = 0
+        if initial is not None:
+            self.tokens.append(initial)
+        while len(self.tokens) < self.size:
+            self.tokens.append(self.authenticate())
+        self.running = True
+        thread = threading.Thread(target = self.refresh_worker)
+        thread.daemon = True
+        thread.start()
+
+    def authenticate(self):
+        token, _, _, _ = self.api.token(*self.credentials)
+        return token
+
+    def add(self, token):
+        with self.lock:
+            if len(self.tokens) >= self.size:
+                self.tokens.pop(0)
+            self.tokens.append(token)
+
+    def get(self):
+        """Return a token, either from the pool or freshly authenticated."""
+        if self.hit_ratio < 1 and random.random() >= self.hit_ratio:
+            token = self.authenticate()
+            self.add(token)
+            with self.lock:
+                self.misses += 1
+            return token
+        with self.lock:
+            self.next = (self.next + 1) % len(self.tokens)
+            self.hits += 1
+            return self.tokens[self.next]
+
+    def measured_hit_ratio(self):
+        """Fraction of lookups so far served from the pool, None before the first lookup."""
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else None
+
+    def refresh_worker(self):
+        while self.running:
+            time.sleep(TOKEN_CHECK_INTERVAL)
+            limit = time.time() + self.refresh_margin
+            with self.lock:
+                expiring = [ t for t in self.tokens if token_expiry(t) <= limit ]
+            for old in expiring:
+                try:
+                    new = self.authenticate()
+                except Exception as e:
+                    print("Failed to refresh token: %s" % e)
+                    continue
+                with self.lock:
+                    if old in self.tokens:
+                        self.tokens[self.tokens.index(old)] = new
+
+    def close(self):
+        self.running = False
+
 def authenticated(func):
+    @functools.wraps(func)
     def decorated(self, *args, **kwargs):
         if not self.is_authenticated():
             raise Exception("Not authenticated yet.")
@@ -191,9 +631,18 @@ def authenticated(func):
     return decorated
 
 class KeystoneSession(object):
-    def __init__(self, identity_host=None, identity_port=None, identity_endpoint=None, identity_version="v2.0"):
+    """Authentication and service catalog. All APIs created by get_api share the connections of the session."""
+    def __init__(self, identity_host=None, identity_port=None, identity_endpoint=None, identity_version="v2.0", http=None,
+            version_cache=None, version_cache_ttl=VERSION_CACHE_TTL):
         self.token = self.services = self.user = self.meta = None
-        self.api = BasicIdentityApi(host=identity_host, port=identity_port, endpoint=identity_endpoint)
+        self.api = BasicIdentityApi(host=identity_host, port=identity_port, endpoint=identity_endpoint, http=http)
+        self.http = self.api.http
+        self.credentials = None
+        self.token_pool = None
+        self.version_cache = None
+        if version_cache:
+            self.version_cache = VersionCache(version_cache, self.api.endpoint, version_cache_ttl)
+            self.api.version_cache = self.version_cache
         versions = self.api.versions()
         if identity_version not in versions:
             raise Exception("Version %s not supported by endpoint '%s'. Supported versions: %s" % (identity_version, self.api.endpoint, versions.keys()))
@@ -205,14 +654,24 @@ class KeystoneSession(object):
         return self.token is not None
 
     def authenticate(self, tenant, user, password, overwrite_host=None):
+        self.credentials = (tenant, user, password)
         self.token, self.services, self.user, self.meta = self.api.token(tenant, user, password)
         if overwrite_host:
             # This is a hack in order to work with an OpenStack system which delivers wrong host names
             for endpoint in self.services.values():
                 endpoint.fix_host(overwrite_host)
 
+    @authenticated
+    def use_token_pool(self, size=1, hit_ratio=1.0, refresh_margin=TOKEN_REFRESH_MARGIN):
+        """Take tokens from a TokenPool, which keeps them valid and puts a controlled share of lookups on Keystone."""
+        if self.token_pool is not None:
+            self.token_pool.close()
+        self.token_pool = TokenPool(self.api, self.credentials, size, hit_ratio, refresh_margin, initial=self.token)
+
     @authenticated
     def token_id(self):
+        if self.token_pool is not None:
+            return self.token_pool.get()["id"]
         return self.token["id"]
 
     @authenticated
@@ -239,7 +698,7 @@ class KeystoneSession(object):
                 instance = klass(self)
                 endpoint_map[endpoint_type] = instance
             elif len(endpoint_map) == 1:
-                instance = endpoint_map.values()[0]
+                instance = list(endpoint_map.values())[0]
             else:
                 raise Exception("Multiple endpoint_types for service %s available, but no endpoint_type specified." % service_type)
         else:
@@ -252,10 +711,12 @@ class KeystoneSession(object):
         return instance
 
     def _get_service_api_class(self, service_type):
-        api_klasses = KeystoneSession.get_all_api_classes()
-        for klass in api_klasses:
-            if service_type in klass.supported_service_types:
-                return klass
+        index = KeystoneSession.api_class_index()
+        if service_type not in index:
+            # API classes might have been defined after the index was built
+            index = KeystoneSession.api_class_index(rebuild=True)
+        if service_type in index:
+            return index[service_type]
         services = self.get_all_service_types()
         raise Exception("No API class found for service type %s. Available services: %s" % (service_type, services))
 
@@ -265,6 +726,19 @@ class KeystoneSession(object):
             return cls.__subclasses__() + [g for s in cls.__subclasses__() for g in all_subclasses(s)]
         return all_subclasses(AuthenticatedOpenstackApi)
 
+    # Service type -> API class, built on first use
+    _api_class_index = None
+
+    @staticmethod
+    def api_class_index(rebuild=False):
+        if rebuild or KeystoneSession._api_class_index is None:
+            index = {}
+            for klass in KeystoneSession.get_all_api_classes():
+                for service_type in klass.supported_service_types:
+                    index.setdefault(service_type, klass)
+            KeystoneSession._api_class_index = index
+        return KeystoneSession._api_class_index
+
     @staticmethod
     def get_all_service_types():
         import operator
@@ -276,6 +750,8 @@ class AuthenticatedOpenstackApi(OpenstackApi):
     default_service_type = None
     default_version = None
     default_endpoint_type = Endpoint.PUBLIC
+    # Types of resources that can be created and deleted: collection path and default attributes by type name
+    resources = {}
 
     def __init__(self, session, service_type=None, endpoint_type=None, version=None):
         if not service_type:
@@ -289,16 +765,59 @@ class AuthenticatedOpenstackApi(OpenstackApi):
         endpoint = session.get_endpoint(service_type)[endpoint_type]
         self.service_type = service_type
         self.endpoint_type = endpoint_type
-        super(AuthenticatedOpenstackApi, self).__init__(session=session, endpoint=endpoint)
-        try:
-            self.check_endpoint(version)
-        except:
-            # Not all subclasses support versions() method
-            pass
+        super(AuthenticatedOpenstackApi, self).__init__(session=session, endpoint=endpoint, http=session.http)
+        self.version_cache = session.version_cache
+        # The endpoint is checked against the versions of the service on first use
+        self.version = version
+        self.endpoint_checked = False
+        self.check_lock = threading.Lock()
+
+    def check_endpoint_once(self):
+        if self.endpoint_checked:
+            return
+        with self.check_lock:
+            if self.endpoint_checked:
+                return
+            try:
+                self.check_endpoint(self.version)
+            except:
+                # Not all subclasses support versions() method
+                pass
+            self.endpoint_checked = True
+
+    def get(self, path, params={}, read=None):
+        self.check_endpoint_once()
+        return super(AuthenticatedOpenstackApi, self).get(path, params, read)
+
+    def send(self, method, path, data=None):
+        self.check_endpoint_once()
+        return super(AuthenticatedOpenstackApi, self).send(method, path, data)
 
     def example(self):
         raise NotImplementedException("No example API-call implemented for this API.")
 
+    @authenticated
+    def create(self, resource, name, **attributes):
+        """Create a resource of one of the types in the resources attribute, return its attributes."""
+        path, defaults = self.resources[resource]
+        data = dict(defaults, name=name, **attributes)
+        return self.post(path, { resource: data })[resource]
+
+    @authenticated
+    def show(self, resource, id):
+        path, _ = self.resources[resource]
+        return self.get("%s/%s" % (path, id))[resource]
+
+    @authenticated
+    def update(self, resource, id, **attributes):
+        path, _ = self.resources[resource]
+        return self.put("%s/%s" % (path, id), { resource: attributes })[resource]
+
+    @authenticated
+    def destroy(self, resource, id):
+        path, _ = self.resources[resource]
+        self.delete("%s/%s" % (path, id))
+
     def check_endpoint(self, version):
         versions = self.versions()
         if version not in versions:
@@ -316,23 +835,32 @@ class IdentityAdminApi(AuthenticatedOpenstackApi):
     default_service_type = "identity"
     default_endpoint_type = Endpoint.ADMIN
     default_version = "v2.0" # v2.0 v2.0-admin v2.0-extensions v3 v3-extensions
+    resources = { "user": ("users", { "enabled": True, "password": "loadgen" }) }
 
     def parse_versions(self, versions):
         return versions["versions"]["values"]
 
     @authenticated
+    @list_operation("users", key="users", field="username")
     def users(self):
-        return [ x["username"] for x in self.get("users")["users"] ]
+        """Names of all users."""
     example = users
 
+    def create_user(self, name, password="loadgen"):
+        return self.create("user", name, password=password)
+
+    def delete_user(self, id):
+        self.destroy("user", id)
+
 class ComputeApi(AuthenticatedOpenstackApi):
     supported_service_types = [ "compute" ]
     default_service_type = "compute"
     default_version = "v2.0" # + v2.0-extensions + v2.1
 
     @authenticated
+    @list_operation("servers", key="servers")
     def servers(self):
-        return [ x["name"] for x in self.get("servers")["servers"] ]
+        """Names of all servers of the tenant."""
     example = servers
 
 class ImageApi(AuthenticatedOpenstackApi):
@@ -341,30 +869,47 @@ class ImageApi(AuthenticatedOpenstackApi):
     default_version = "v1.1" # v2.1
 
     @authenticated
+    @list_operation("images", key="images")
     def images(self):
-        return [ x["name"] for x in self.get("images")["images"] ]
+        """Names of all images."""
     example = images
 
 class VolumeApi(AuthenticatedOpenstackApi):
     supported_service_types = [ "volume" ]
     default_service_type = "volume"
     default_version = "v2.0" # + v1.0
+    resources = { "volume": ("volumes", { "size": 1 }) }
 
     @authenticated
+    @list_operation("volumes", key="volumes")
     def volumes(self):
-        return [ x["name"] for x in self.get("volumes")["volumes"] ]
+        """Names of all volumes of the tenant."""
     example = volumes
 
+    def create_volume(self, name, size=1):
+        return self.create("volume", name, size=size)
+
+    def delete_volume(self, id):
+        self.destroy("volume", id)
+
 class NetworkApi(AuthenticatedOpenstackApi):
     supported_service_types = [ "network" ]
     default_service_type = "network"
     default_version = "v2.0" # + v2.0 extensions
+    resources = { "network": ("networks", { "admin_state_up": True }) }
 
     @authenticated
+    @list_operation("networks", key="networks")
     def networks(self):
-        return [ x["name"] for x in self.get('networks')["networks"] ]
+        """Names of all networks."""
     example = networks
 
+    def create_network(self, name):
+        return self.create("network", name)
+
+    def delete_network(self, id):
+        self.destroy("network", id)
+
     def network_list(self):
         networks = self.networks()
         return { n["id"]: n["name"] for n in networks }
@@ -373,10 +918,12 @@ class ObjectStorageApi(AuthenticatedOpenstackApi):
     supported_service_types = [ "object-store" ]
     default_service_type = "object-store"
     default_version = "v1.0"
+    marker_field = "name"
 
     @authenticated
+    @list_operation("")
     def containers(self):
-        return [ x["name"] for x in self.get("") ]
+        """Names of all containers of the account."""
     example = containers
 
     def versions(self):
@@ -388,8 +935,9 @@ class OrchestrationApi(AuthenticatedOpenstackApi):
     default_version = "v1.0"
 
     @authenticated
+    @list_operation("stacks", field="stack_name")
     def stacks(self):
-        return [ x["stack_name"] for x in self.get("stacks") ]
+        """Names of all stacks."""
     example = stacks
 
 class TelemetryApi(AuthenticatedOpenstackApi):
@@ -398,8 +946,9 @@ class TelemetryApi(AuthenticatedOpenstackApi):
     default_version = "v2.0"
 
     @authenticated
+    @list_operation("alarms")
     def alarms(self):
-        return [ x["name"] for x in self.get('alarms') ]
+        """Names of all alarms."""
     example = alarms
 
     def versions(self):